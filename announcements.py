@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""announcements.py
+
+The "nearly sold out" announcement. The set of conferences with only a few
+seats left is kept in a single NearlySoldOut entity that is updated as soon
+as a conference's seatsAvailable crosses the threshold in either direction,
+and the announcement string in memcache is rebuilt from it on every change.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import NearlySoldOut
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+NEARLY_SOLD_OUT_SEATS = 5
+NEARLY_SOLD_OUT_ID = 'nearly_sold_out'
+
+
+def isNearlySoldOut(seats):
+    """Return True if `seats` available puts a conference in the announcement."""
+    return seats is not None and 0 < seats <= NEARLY_SOLD_OUT_SEATS
+
+
+def _nearlySoldOutKey():
+    return ndb.Key(NearlySoldOut, NEARLY_SOLD_OUT_ID)
+
+
+def _formatAnnouncement(conferenceNames):
+    """Return the announcement for {websafeConferenceKey: name}."""
+    if not conferenceNames:
+        return ""
+    return ANNOUNCEMENT_TPL % ', '.join(sorted(conferenceNames.values()))
+
+
+def _cacheAnnouncement(conferenceNames):
+    """Format the announcement for {websafeConferenceKey: name} and put it
+    in memcache; an empty string is cached too so readers never miss."""
+    announcement = _formatAnnouncement(conferenceNames)
+    memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    return announcement
+
+
+# independent: it runs from call_on_commit callbacks, where the finished
+# transaction is still the current one
+@ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+def _updateNearlySoldOut(wsck, name, nearlySoldOut):
+    """Add or remove one conference; returns the new set, or None if it
+    did not change."""
+    entity = _nearlySoldOutKey().get() or NearlySoldOut(
+        key=_nearlySoldOutKey(), conferenceNames={})
+    names = entity.conferenceNames
+    if nearlySoldOut:
+        if names.get(wsck) == name:
+            return None
+        names[wsck] = name
+    else:
+        if wsck not in names:
+            return None
+        del names[wsck]
+    entity.put()
+    return names
+
+
+def seatsChanged(conf_key, name, seats):
+    """Record a conference's new seatsAvailable, updating the set and the
+    cached announcement if it joins or leaves the set (or is renamed)."""
+    names = _updateNearlySoldOut(conf_key.urlsafe(), name, isNearlySoldOut(seats))
+    if names is not None:
+        _cacheAnnouncement(names)
+
+
+def onCommitSeatsChanged(conf, oldSeats):
+    """Call seatsChanged after the current transaction commits when conf's
+    seatsAvailable (changed from oldSeats) crosses the threshold, or when
+    it is in the set already and may have been renamed."""
+    if isNearlySoldOut(oldSeats) or isNearlySoldOut(conf.seatsAvailable):
+        conf_key, name, seats = conf.key, conf.name, conf.seatsAvailable
+        ndb.get_context().call_on_commit(
+            lambda: seatsChanged(conf_key, name, seats))
+
+
+def nearlySoldOutKeys():
+    """Return the keys of the conferences currently in the set."""
+    entity = _nearlySoldOutKey().get()
+    if not entity:
+        return []
+    return [ndb.Key(urlsafe=wsck) for wsck in entity.conferenceNames]
+
+
+@ndb.transactional()
+def resetNearlySoldOut(conferenceNames):
+    """Replace the whole set (reconciliation) and return the announcement."""
+    NearlySoldOut(key=_nearlySoldOutKey(), conferenceNames=conferenceNames).put()
+    ndb.get_context().call_on_commit(lambda: _cacheAnnouncement(conferenceNames))
+    return _formatAnnouncement(conferenceNames)
+
+
+def getAnnouncement():
+    """Return the announcement from memcache, rebuilding it from the set
+    (a single get) when memcache has lost it."""
+    announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+    if announcement is None:
+        entity = _nearlySoldOutKey().get()
+        announcement = _cacheAnnouncement(entity.conferenceNames if entity else {})
+    return announcement
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Offline load test for ConferenceApi. Runs the API in process against the
+App Engine testbed stubs (datastore_v3, memcache, taskqueue, urlfetch,
+mail), seeds a synthetic dataset, drives each endpoint at a given
+concurrency and writes per-endpoint latency percentiles, datastore RPC
+counts and serialized bytes as JSON, so two commits can be compared:
+
+    python benchmark.py --output before.json
+    git checkout other-branch
+    python benchmark.py --output after.json --baseline before.json
+
+Needs the App Engine SDK on sys.path (set --sdk or APPENGINE_SDK). Not
+part of the deployed app.
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+
+def _setupSdkPath(sdk):
+    """Put the SDK and its bundled libraries on sys.path."""
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+DATASET_DEFAULTS = {
+    'conferences': 200,
+    'sessions': 2000,
+    'profiles': 500,
+    'speakers': 300,
+    'registrations': 4,     # per profile
+    'wishlist': 4,          # sessions per profile
+}
+CITIES = ('London', 'Chicago', 'Paris', 'Tokyo', 'San Francisco', 'Berlin')
+TOPICS = ('Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition')
+SEED_BATCH_SIZE = 500
+
+
+class RpcCounter(object):
+    """Per thread count and size of datastore_v3 RPCs, filled by an
+    apiproxy post call hook."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def reset(self):
+        self._local.calls = 0
+        self._local.bytes = 0
+
+    def read(self):
+        return getattr(self._local, 'calls', 0), getattr(self._local, 'bytes', 0)
+
+    def count(self, service, call, request, response):
+        if service == 'datastore_v3':
+            self._local.calls = getattr(self._local, 'calls', 0) + 1
+            self._local.bytes = (getattr(self._local, 'bytes', 0) +
+                                 request.ByteSize() + response.ByteSize())
+
+
+class Benchmark(object):
+    """A seeded testbed plus the request generators for each endpoint."""
+
+    def __init__(self, dataset, seed):
+        self.dataset = dataset
+        self.rng = random.Random(seed)
+        self.rpcs = RpcCounter()
+
+    # - - - environment - - - - - - - - - - - - - - - - - - - -
+
+    def setUp(self):
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        from google.appengine.runtime import request_environment
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # endpoints.api_server rejects testbed's default version id
+        self.testbed.setup_env(app_id='conference-benchmark',
+                               current_version_id='v1.1', overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(__file__))
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark_rpcs', self.rpcs.count, 'datastore_v3')
+
+        # os.environ carries the Endpoints user, so give each worker thread
+        # its own copy, as the production runtime does
+        self.baseEnviron = dict(os.environ)
+        request_environment.PatchOsEnviron()
+        self.requestEnvironment = request_environment.current_request
+        self._setUser(None)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def _setUser(self, email):
+        environ = dict(self.baseEnviron)
+        environ['ENDPOINTS_AUTH_EMAIL'] = email or ''
+        environ['ENDPOINTS_AUTH_DOMAIN'] = 'gmail.com'
+        self.requestEnvironment.Init(sys.stderr, environ)
+
+    # - - - dataset - - - - - - - - - - - - - - - - - - - -
+
+    def _putBatched(self, entities):
+        from google.appengine.ext import ndb
+        for i in range(0, len(entities), SEED_BATCH_SIZE):
+            ndb.put_multi(entities[i:i + SEED_BATCH_SIZE])
+
+    def _reserveIds(self, model, keys):
+        """Reserve the ids of seeded `keys`, so the endpoints' allocate_ids
+        cannot hand them out again and overwrite seeded entities."""
+        from google.appengine.ext import ndb
+        maxIds = {}
+        for key in keys:
+            maxIds[key.parent()] = max(maxIds.get(key.parent(), 0), key.id())
+        ndb.Future.wait_all([model.allocate_ids_async(max=maxId, parent=parent)
+                             for parent, maxId in maxIds.items()])
+
+    def seed(self):
+        """Write the synthetic dataset straight to the datastore, with the
+        derived entities (seat shards, speaker index, tallies) the write
+        paths would have made."""
+        from google.appengine.ext import ndb
+        from conference import ConferenceApi
+        from models import Conference, Profile, Registration, Session
+        from models import SpeakerSession, SpeakerTally, WishlistEntry
+        import seats
+        import speakers
+
+        rng, ds = self.rng, self.dataset
+        self.emails = ['user%d@gmail.com' % i for i in range(ds['profiles'])]
+        self._putBatched([Profile(key=ndb.Key(Profile, email),
+                                  displayName=email.split('@')[0], mainEmail=email,
+                                  teeShirtSize='NOT_SPECIFIED')
+                          for email in self.emails])
+
+        entities, self.confs = [], []
+        today = datetime.date.today()
+        for i in range(ds['conferences']):
+            organizer = rng.choice(self.emails)
+            p_key = ndb.Key(Profile, organizer)
+            c_key = ndb.Key(Conference, i + 1, parent=p_key)
+            maxAttendees = rng.choice((0, 5, 50, 200, 1000))
+            start = today + datetime.timedelta(days=rng.randint(-30, 300))
+            conf = Conference(
+                key=c_key, name='Conference %d' % i, organizerUserId=organizer,
+                organizerDisplayName=organizer.split('@')[0],
+                topics=rng.sample(TOPICS, 2), city=rng.choice(CITIES),
+                startDate=start, endDate=start + datetime.timedelta(days=2),
+                month=start.month, maxAttendees=maxAttendees,
+                seatsAvailable=maxAttendees,
+                seatShards=seats.seatShardCount(maxAttendees))
+            self.confs.append(conf)
+            entities.append(conf)
+            entities.extend(seats.buildSeatShards(
+                c_key, conf.seatsAvailable, conf.seatShards))
+        self._putBatched(entities)
+        self._reserveIds(Conference, [conf.key for conf in self.confs])
+
+        speakerNames = ['Speaker %d' % i for i in range(ds['speakers'])]
+        self.speakers = speakerNames
+        entities, self.sessionKeys = [], []
+        tallies = {}
+        for i in range(ds['sessions']):
+            conf = rng.choice(self.confs)
+            s_key = ndb.Key(Session, i + 1, parent=conf.key)
+            speaker = rng.choice(speakerNames)
+            session = Session(
+                key=s_key, name='Session %d' % i, speaker=speaker,
+                typeOfSession=rng.choice(('NOT_SPECIFIED', 'LECTURE', 'KEYNOTE',
+                                          'WORKSHOP', 'FORUM')),
+                sessionDate=conf.startDate,
+                startTime=datetime.time(rng.randint(8, 21), 0),
+                duration=rng.choice((30, 60, 90)))
+            entities.append(session)
+            self.sessionKeys.append(s_key)
+            entities.append(SpeakerSession(
+                key=speakers.speakerSessionKey(speaker, s_key),
+                speaker=speakers.normalizeSpeakerName(speaker), sessionKey=s_key))
+            tallies.setdefault(conf.key, {}).setdefault(speaker, []).append(
+                session.name)
+        entities += [SpeakerTally(key=ConferenceApi._speakerTallyKey(c_key),
+                                  sessionNames=names)
+                     for c_key, names in tallies.items()]
+        self._putBatched(entities)
+        self._reserveIds(Session, self.sessionKeys)
+
+        entities = []
+        for email in self.emails:
+            p_key = ndb.Key(Profile, email)
+            for conf in rng.sample(self.confs, min(ds['registrations'], len(self.confs))):
+                entities.append(Registration(
+                    key=ndb.Key(Registration, conf.key.urlsafe(), parent=p_key),
+                    conferenceKey=conf.key))
+            for s_key in rng.sample(self.sessionKeys,
+                                    min(ds['wishlist'], len(self.sessionKeys))):
+                entities.append(WishlistEntry(
+                    key=ndb.Key(WishlistEntry, s_key.urlsafe(), parent=p_key),
+                    sessionKey=s_key))
+        self._putBatched(entities)
+
+    # - - - endpoints - - - - - - - - - - - - - - - - - - - -
+
+    def _request(self, method, **fields):
+        from conference import ConferenceApi
+        return getattr(ConferenceApi, method).remote.request_type(**fields)
+
+    def _conf(self):
+        return self.rng.choice(self.confs)
+
+    def _wsck(self):
+        return self._conf().key.urlsafe()
+
+    def _wssk(self):
+        return self.rng.choice(self.sessionKeys).urlsafe()
+
+    def _user(self):
+        return self.rng.choice(self.emails)
+
+    def scenarios(self):
+        """Return {endpoint: factory}, the factory returning (user, request)
+        for one call."""
+        from models import ConferenceForm, ConferenceQueryForm
+        from models import ConferenceQueryForms, ProfileMiniForm
+        from models import SessionQueryForm, TypeOfSession
+        from models import WishlistForm
+        from protorpc import message_types
+
+        rng = self.rng
+        void = lambda: message_types.VoidMessage()
+
+        def organizerConf():
+            conf = self._conf()
+            return conf.organizerUserId, conf.key.urlsafe()
+
+        def createSession():
+            user, wsck = organizerConf()
+            return user, self._request(
+                'createSession', websafeConferenceKey=wsck,
+                name='Bench session', speaker=rng.choice(self.speakers),
+                typeOfSession=rng.choice(list(TypeOfSession)),
+                startTime='10:00', sessionDate='2030-01-01', duration=60)
+
+        def updateConference():
+            user, wsck = organizerConf()
+            return user, self._request(
+                'updateConference', websafeConferenceKey=wsck,
+                description='Updated %d' % rng.randint(0, 1 << 30))
+
+        return {
+            'createConference': lambda: (self._user(), ConferenceForm(
+                name='Bench conference', city=rng.choice(CITIES),
+                topics=[rng.choice(TOPICS)], maxAttendees=100,
+                startDate='2030-01-01', endDate='2030-01-02')),
+            'updateConference': updateConference,
+            'getConference': lambda: (self._user(), self._request(
+                'getConference', websafeConferenceKey=self._wsck())),
+            'getConferencesCreated': lambda: (self._user(), self._request(
+                'getConferencesCreated', pageSize=20)),
+            'queryConferences': lambda: (self._user(), ConferenceQueryForms(
+                filters=[ConferenceQueryForm(field='CITY', operator='EQ',
+                                             value=rng.choice(CITIES)),
+                         ConferenceQueryForm(field='MAX_ATTENDEES', operator='GT',
+                                             value='10')],
+                pageSize=20)),
+            'getProfile': lambda: (self._user(), self._request('getProfile')),
+            'saveProfile': lambda: (self._user(), ProfileMiniForm(
+                displayName='Renamed %d' % rng.randint(0, 1000))),
+            'getAnnouncement': lambda: (self._user(), void()),
+            'getConferencesToAttend': lambda: (self._user(), self._request('getConferencesToAttend')),
+            'registerForConference': lambda: (self._user(), self._request(
+                'registerForConference', websafeConferenceKey=self._wsck())),
+            'unregisterFromConference': lambda: (self._user(), self._request(
+                'unregisterFromConference', websafeConferenceKey=self._wsck())),
+            'filterPlayground': lambda: (self._user(), void()),
+            'querySessions': lambda: (self._user(), self._request(
+                'querySessions', pageSize=20)),
+            'getConferenceSessions': lambda: (self._user(), self._request(
+                'getConferenceSessions', websafeConferenceKey=self._wsck())),
+            'getConferenceSessionsByType': lambda: (self._user(), self._request(
+                'getConferenceSessionsByType', websafeConferenceKey=self._wsck(),
+                typeOfSession='LECTURE')),
+            'getSessionsBySpeaker': lambda: (self._user(), self._request(
+                'getSessionsBySpeaker', speaker=rng.choice(self.speakers))),
+            'createSession': createSession,
+            'querySessionsAdvanced': lambda: (self._user(), SessionQueryForm(
+                excludeTypeOfSession=[TypeOfSession.WORKSHOP],
+                startTimeBefore='19:00', pageSize=20)),
+            'queryNonWorkshopSessionsBefore7pm': lambda: (self._user(), self._request(
+                'queryNonWorkshopSessionsBefore7pm', pageSize=20)),
+            'addSessionToWishlist': lambda: (self._user(), self._request(
+                'addSessionToWishlist', websafeSessionKey=self._wssk())),
+            'addSessionsToWishlist': lambda: (self._user(), WishlistForm(
+                websafeSessionKeys=[self._wssk() for _ in range(5)])),
+            'getSessionsInWishlist': lambda: (self._user(), void()),
+            'deleteSessionInWishlist': lambda: (self._user(), self._request(
+                'deleteSessionInWishlist', websafeSessionKey=self._wssk())),
+            'deleteSessionsInWishlist': lambda: (self._user(), WishlistForm(
+                websafeSessionKeys=[self._wssk() for _ in range(5)])),
+            'getFeaturedSpeaker': lambda: (self._user(), self._request(
+                'getFeaturedSpeaker', websafeConferenceKey=self._wsck())),
+            'getAllSessionsByType': lambda: (self._user(), self._request(
+                'getAllSessionsByType', typeOfSession='KEYNOTE', pageSize=20)),
+            'getWorkshopsStartingSoonForConference': lambda: (self._user(), self._request(
+                'getWorkshopsStartingSoonForConference',
+                websafeConferenceKey=self._wsck())),
+        }
+
+    # - - - running - - - - - - - - - - - - - - - - - - - -
+
+    def _call(self, api, method, user, request):
+        """Run one API call as `user`; returns (seconds, rpcs, rpc bytes,
+        response bytes, error)."""
+        from google.appengine.ext import ndb
+        from protorpc import protojson
+
+        self._setUser(user)
+        # every request starts with an empty ndb context cache
+        ndb.get_context().clear_cache()
+        self.rpcs.reset()
+        error = None
+        start = time.time()
+        try:
+            response = getattr(api, method)(request)
+        except Exception as e:
+            response, error = None, '%s: %s' % (type(e).__name__, e)
+        elapsed = time.time() - start
+        calls, rpcBytes = self.rpcs.read()
+        size = len(protojson.encode_message(response)) if response else 0
+        return elapsed, calls, rpcBytes, size, error
+
+    def runEndpoint(self, method, factory, requests, concurrency):
+        """Call `method` `requests` times from `concurrency` threads."""
+        from conference import ConferenceApi
+
+        # build every request up front so generation is not timed
+        work = [factory() for _ in range(requests)]
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            api = ConferenceApi()
+            while True:
+                with lock:
+                    if not work:
+                        return
+                    user, request = work.pop()
+                result = self._call(api, method, user, request)
+                with lock:
+                    results.append(result)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        wallStart = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(results, time.time() - wallStart)
+
+    def drainTasks(self, limit=10000):
+        """Run the queued tasks through main.app (tasks may queue more);
+        returns the number run."""
+        import webapp2
+        from main import app
+
+        self._setUser(None)
+        run = 0
+        while run < limit:
+            # the stub's tasks carry neither their queue nor the PULL
+            # method, so go by the queues' mode
+            queues = [(queue['name'], queue['mode'])
+                      for queue in self.taskqueue.GetQueues()
+                      if queue['tasks_in_queue']]
+            if not queues:
+                break
+            tasks = self.taskqueue.get_filtered_tasks(
+                queue_names=[name for name, mode in queues if mode == 'push'])
+            # pull tasks (confirmation emails) are dropped, not run
+            for name, _ in queues:
+                self.taskqueue.FlushQueue(name)
+            for task in tasks:
+                request = webapp2.Request.blank(task.url, method=task.method,
+                                                POST=task.payload or '')
+                request.get_response(app)
+                run += 1
+        return run
+
+
+def percentile(values, p):
+    """Nearest rank percentile of sorted `values`."""
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(results, wall):
+    """Aggregate _call results into the per endpoint report."""
+    latencies = sorted(r[0] * 1000.0 for r in results)
+    n = len(results) or 1
+    errors = [r[4] for r in results if r[4]]
+    return {
+        'requests': len(results),
+        'errors': len(errors),
+        'sample_error': errors[0] if errors else None,
+        'throughput_rps': round(len(results) / wall, 2) if wall else None,
+        'mean_ms': round(sum(latencies) / n, 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'datastore_rpcs': round(sum(r[1] for r in results) / float(n), 2),
+        'datastore_bytes': int(sum(r[2] for r in results) / n),
+        'response_bytes': int(sum(r[3] for r in results) / n),
+    }
+
+
+def compare(report, baseline):
+    """Print p95, RPC and byte ratios of `report` against `baseline`."""
+    print('%-40s %10s %10s %10s' % ('endpoint', 'p95', 'rpcs', 'bytes'))
+    for name, cur in sorted(report['endpoints'].items()):
+        old = baseline.get('endpoints', {}).get(name)
+        if not old:
+            continue
+        ratios = []
+        for stat in ('p95_ms', 'datastore_rpcs', 'datastore_bytes'):
+            ratios.append('%.2fx' % (cur[stat] / float(old[stat]))
+                          if old[stat] else '-')
+        print('%-40s %10s %10s %10s' % tuple([name] + ratios))
+
+
+def _gitRevision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='App Engine SDK directory')
+    for name, default in sorted(DATASET_DEFAULTS.items()):
+        parser.add_argument('--' + name, type=int, default=default,
+                            help='dataset size (default %d)' % default)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='calls per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--endpoints', nargs='*',
+                        help='endpoints to run (default: all)')
+    parser.add_argument('--run-tasks', action='store_true',
+                        help='run queued tasks after each endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='earlier report to compare with')
+    args = parser.parse_args(argv)
+
+    _setupSdkPath(args.sdk)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    dataset = dict((name, getattr(args, name)) for name in DATASET_DEFAULTS)
+    bench = Benchmark(dataset, args.seed)
+    bench.setUp()
+    try:
+        start = time.time()
+        bench.seed()
+        report = {
+            'revision': _gitRevision(),
+            'dataset': dataset,
+            'seed_seconds': round(time.time() - start, 1),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'endpoints': {},
+        }
+        scenarios = bench.scenarios()
+        for name in args.endpoints or sorted(scenarios):
+            result = bench.runEndpoint(name, scenarios[name],
+                                       args.requests, args.concurrency)
+            if args.run_tasks:
+                result['tasks_run'] = bench.drainTasks()
+            report['endpoints'][name] = result
+            print('%-40s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  rpcs %6.2f%s' % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['datastore_rpcs'],
+                '  errors %d' % result['errors'] if result['errors'] else ''))
+    finally:
+        bench.tearDown()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""bulkload.py
+
+Offline loader for conference programmes. Reads a JSON file of the form
+
+    {"conferences": [
+        {"conference": {"name": ..., "city": ..., ...},
+         "sessions": [{"name": ..., "speaker": ..., ...}, ...]},
+        {"websafeConferenceKey": "...", "sessions": [...]}
+    ]}
+
+(ConferenceForm / SessionForm fields) and sends it to the bulkImport
+endpoint in requests under the server's per-call limits. A conference with
+more sessions than fit in one request is created by the first request and
+the rest of its sessions follow in later requests, addressed by its key.
+
+    python bulkload.py programme.json --host https://APP_ID.appspot.com \\
+        --token "$(gcloud auth print-access-token)"
+
+"""
+
+import argparse
+import json
+import sys
+import urllib2
+
+# keep in step with MAX_IMPORT_CONFERENCES / MAX_IMPORT_SESSIONS in conference.py
+MAX_IMPORT_CONFERENCES = 50
+MAX_IMPORT_SESSIONS = 1000
+API_PATH = '/_ah/api/conference/v1/bulkImport'
+
+
+def _requests(conferences):
+    """Yield (imports, pending) where imports is one request's worth of
+    conference imports; pending lists (import index, remaining sessions) of
+    new conferences whose remaining sessions must wait for their key."""
+    batch, pending, sessionCount = [], [], 0
+    for conf in conferences:
+        sessions = list(conf.get('sessions', []))
+        while True:
+            if (len(batch) == MAX_IMPORT_CONFERENCES or
+                    (sessions and sessionCount == MAX_IMPORT_SESSIONS)):
+                yield batch, pending
+                batch, pending, sessionCount = [], [], 0
+            room = MAX_IMPORT_SESSIONS - sessionCount
+            batch.append(dict(conf, sessions=sessions[:room]))
+            sessionCount += len(sessions[:room])
+            sessions = sessions[room:]
+            if not sessions:
+                break
+            if 'websafeConferenceKey' not in conf:
+                # the rest goes out once the conference has a key
+                pending.append((len(batch) - 1, sessions))
+                break
+    if batch:
+        yield batch, pending
+
+
+def _post(host, token, imports):
+    request = urllib2.Request(
+        host.rstrip('/') + API_PATH, json.dumps({'conferences': imports}),
+        {'Content-Type': 'application/json',
+         'Authorization': 'Bearer %s' % token})
+    return json.load(urllib2.urlopen(request))
+
+
+def load(host, token, conferences):
+    """Import `conferences`; returns the websafe keys of the conferences."""
+    keys = []
+    queue = list(conferences)
+    while queue:
+        followUps = []
+        for imports, pending in _requests(queue):
+            result = _post(host, token, imports)
+            items = result.get('items', [])
+            for index, sessions in pending:
+                followUps.append({'websafeConferenceKey':
+                                  items[index]['websafeConferenceKey'],
+                                  'sessions': sessions})
+            for imp, item in zip(imports, items):
+                if 'websafeConferenceKey' not in imp:
+                    keys.append(item['websafeConferenceKey'])
+            sys.stderr.write('imported %d conferences, %d sessions\n' % (
+                len(imports), sum(len(imp['sessions']) for imp in imports)))
+        queue = followUps
+    return keys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('file', help='JSON programme file')
+    parser.add_argument('--host', default='http://localhost:8080')
+    parser.add_argument('--token', required=True,
+                        help='OAuth access token of the organizer')
+    args = parser.parse_args(argv)
+
+    with open(args.file) as f:
+        conferences = json.load(f)['conferences']
+    for key in load(args.host, args.token, conferences):
+        print(key)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Read-through memcache layer for Conference, Session and Profile entities.
+Entries are versioned so a schema change only needs CACHE_VERSION bumped,
+expire after a per-kind TTL, and are invalidated by the write paths once
+their transaction commits.
+
+"""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import unitofwork
+
+CACHE_VERSION = 1
+CACHE_TTL = {
+    'Conference': 10 * 60,
+    'Session': 10 * 60,
+    'Profile': 5 * 60,
+}
+# after an invalidation, refuse refills for this long so a reader that
+# loaded the old entity just before the commit cannot put it back
+INVALIDATION_LOCK = 2
+STATS_KEY_TPL = 'ENTITY_CACHE_v%d_STATS_%s_%s'
+
+
+def _cacheKey(key):
+    """Return the memcache key for an entity key."""
+    return 'ENTITY_CACHE_v%d_%s' % (CACHE_VERSION, key.urlsafe())
+
+
+def _countStats(hits, misses):
+    """Add {kind: count} hits and misses to the memcache counters, async."""
+    offsets = {}
+    for kind, count in hits.items():
+        offsets[STATS_KEY_TPL % (CACHE_VERSION, kind, 'hits')] = count
+    for kind, count in misses.items():
+        offsets[STATS_KEY_TPL % (CACHE_VERSION, kind, 'misses')] = count
+    if offsets:
+        memcache.Client().offset_multi_async(offsets, initial_value=0)
+
+
+def get(key):
+    """Return the entity for `key` from memcache, else from the datastore."""
+    return getMulti([key])[0]
+
+
+def getMulti(keys):
+    """Return the entities for `keys` (None where missing), reading memcache
+    first and fetching only the misses with one get_multi. Inside a
+    transaction the cache is bypassed; entities the request's unit of work
+    has yet to write are returned as pending.
+    """
+    if ndb.in_transaction():
+        # transactions must read (and so lock) the real entities
+        return ndb.get_multi(keys)
+
+    pending = {}
+    for key in keys:
+        entity = unitofwork.getPending(key)
+        if entity is not None:
+            pending[key] = entity
+    if pending:
+        lookup = [key for key in keys if key not in pending]
+        found = dict(zip(lookup, getMulti(lookup) if lookup else []))
+        found.update(pending)
+        return [found[key] for key in keys]
+
+    cache_keys = [_cacheKey(key) for key in keys]
+    cached = memcache.get_multi(cache_keys)
+
+    hits, misses = {}, {}
+    missing = []
+    for key, cache_key in zip(keys, cache_keys):
+        kind = key.kind()
+        if cache_key in cached:
+            hits[kind] = hits.get(kind, 0) + 1
+        else:
+            misses[kind] = misses.get(kind, 0) + 1
+            missing.append(key)
+    _countStats(hits, misses)
+
+    if missing:
+        fills = {}
+        for key, entity in zip(missing, ndb.get_multi(missing)):
+            if entity is not None:
+                cached[_cacheKey(key)] = entity
+                fills.setdefault(CACHE_TTL.get(key.kind(), 0), {})[
+                    _cacheKey(key)] = entity
+        # add rather than set, so a concurrent invalidation wins
+        for ttl, mapping in fills.items():
+            memcache.add_multi(mapping, time=ttl)
+
+    return [cached.get(cache_key) for cache_key in cache_keys]
+
+
+def invalidate(*keys):
+    """Drop `keys` from the cache once the current transaction commits or
+    unit of work flushes (immediately when in neither).
+    """
+    cache_keys = [_cacheKey(key) for key in keys if key is not None]
+    if cache_keys:
+        unitofwork.callOnFlush(
+            lambda: memcache.delete_multi(cache_keys, seconds=INVALIDATION_LOCK))
+
+
+def getStats():
+    """Return {kind: {'hits': n, 'misses': n}} for the cached kinds."""
+    stats_keys = {}
+    for kind in CACHE_TTL:
+        for stat in ('hits', 'misses'):
+            stats_keys[STATS_KEY_TPL % (CACHE_VERSION, kind, stat)] = (kind, stat)
+    values = memcache.get_multi(stats_keys.keys())
+    stats = dict((kind, {'hits': 0, 'misses': 0}) for kind in CACHE_TTL)
+    for stats_key, (kind, stat) in stats_keys.items():
+        stats[kind][stat] = int(values.get(stats_key) or 0)
+    return stats
@@ -14,6 +14,8 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
 from datetime import datetime
+import itertools
+import json
 import time
 
 import endpoints
@@ -23,12 +25,20 @@ from protorpc import remote
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+from models import BulkImportForm
+from models import BulkImportResultForm
+from models import BulkImportResultForms
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import Registration
+from models import WishlistEntry
+from models import WishlistForm
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
@@ -40,7 +50,8 @@ from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
-from models import TypeOfSession
+from models import SessionQueryForm
+from models import SpeakerTally
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
@@ -49,12 +60,36 @@ from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
 
+import announcements
+import cache
+import conferencequery
+import confirmations
+import fragments
+import instrumentation
+import seats
+import serializers
+import sessionquery
+import speakers
+import textindex
+import timetable
+import unitofwork
+import versions
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATURED_SPEAKER_KEY = "CONF_FEAT_SPEAK"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_SCAN_PER_PAGE = 1000    # rows a filtered page may read before returning
+MIGRATION_BATCH_SIZE = 100
+ORGANIZER_NAME_BATCH_SIZE = 100
+SPEAKER_TALLY_ID = 'speakers'
+FEATURED_SPEAKER_DELAY = 5  # seconds new sessions are coalesced for
+FEATURED_SPEAKER_CAS_RETRIES = 5
+STARTING_SOON_COUNT = 3
+MAX_IMPORT_CONFERENCES = 50
+MAX_IMPORT_SESSIONS = 1000
+IMPORT_BATCH_SIZE = 400     # entities per entity group per put
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -74,27 +109,36 @@ SESSION_DEFAULTS = {
     "speaker": "John Doe",
 }
 
-OPERATORS = {
-            'EQ':   '=',
-            'GT':   '>',
-            'GTEQ': '>=',
-            'LT':   '<',
-            'LTEQ': '<=',
-            'NE':   '!='
-            }
-
-FIELDS =    {
-            'CITY': 'city',
-            'TOPIC': 'topics',
-            'MONTH': 'month',
-            'MAX_ATTENDEES': 'maxAttendees',
-            }
-
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_PAGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+    ifNoneMatch=messages.StringField(4),
+)
+
+ETAG_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CONF_ETAG_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+PAGE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -114,12 +158,23 @@ CONF_SESS_POST_REQUEST = endpoints.ResourceContainer(
 SESS_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
 )
 
 SESS_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     speaker=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    pageSize=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
+CONF_DAY_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    date=messages.StringField(2),           # YYYY-MM-DD, default today
+    typeOfSession=messages.StringField(3),
 )
 
 SESS_DELETE_REQUEST = endpoints.ResourceContainer(
@@ -132,6 +187,13 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1),
 )
 
+SEARCH_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 @endpoints.api(name='conference', version='v1', audiences=[ANDROID_AUDIENCE],
@@ -140,40 +202,120 @@ SESS_POST_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+# - - - Paging - - - - - - - - - - - - - - - - - - - - - - -
+    def _fetchPage(self, query, request):
+        """Fetch one page of query results using the request's pageSize and
+        pageToken, returning (entities, nextPageToken).
+        """
+        return self._fetchPageAsync(query, request).get_result()
+
+
+    @ndb.tasklet
+    def _fetchPageAsync(self, query, request, callback=None, predicate=None):
+        """Tasklet version of _fetchPage; callback(entity), if given, is
+        called as each result arrives so dependent lookups can start before
+        the page is complete. Results failing predicate(entity) are skipped;
+        a filtered page stops after MAX_SCAN_PER_PAGE rows, possibly short.
+        """
+        pageSize = request.pageSize or DEFAULT_PAGE_SIZE
+        if pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d" % MAX_PAGE_SIZE)
+        maxScan = pageSize if predicate is None else MAX_SCAN_PER_PAGE
+
+        # same as Query.fetch_page_async, but handing out entities as they come
+        entities = []
+        scanned = 0
+        try:
+            cursor = Cursor(urlsafe=request.pageToken) if request.pageToken else None
+            it = query.iter(limit=maxScan + 1, batch_size=pageSize,
+                            start_cursor=cursor, produce_cursors=True)
+            while (yield it.has_next_async()):
+                entity = it.next()
+                scanned += 1
+                if predicate is None or predicate(entity):
+                    entities.append(entity)
+                    if callback:
+                        callback(entity)
+                    if len(entities) >= pageSize:
+                        break
+                if scanned >= maxScan:
+                    break
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            raise endpoints.BadRequestException(
+                "Invalid pageToken: %s" % request.pageToken)
+
+        # only hand out a token when there really is another page
+        nextPageToken = None
+        if scanned and it.probably_has_next():
+            nextPageToken = it.cursor_after().urlsafe()
+        raise ndb.Return(entities, nextPageToken)
+
+
+    def _speakerPage(self, request):
+        """Return one page of request.speaker's Session keys from the speaker
+        index, using the request's pageSize and pageToken, returning
+        (keys, nextPageToken).
+        """
+        pageSize = request.pageSize or DEFAULT_PAGE_SIZE
+        if pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d" % MAX_PAGE_SIZE)
+        try:
+            return speakers.getSpeakerSessionKeys(
+                request.speaker, pageSize, request.pageToken)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+
+    @staticmethod
+    def _organiserNames(futures):
+        """Return {organizerUserId: displayName} from Profile get futures."""
+        names = {}
+        for user_id, future in futures.items():
+            profile = future.get_result()
+            if profile:
+                names[user_id] = profile.displayName
+        return names
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
-    def _copyConferenceToForm(self, conf, displayName):
+    def _copyConferenceToForm(self, conf):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return self._copyConferencesToForms([conf])[0]
 
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    def _copyConferencesToForms(self, confs, names=None):
+        """Copy a list of Conferences to ConferenceForms in one pass.
 
+        Conferences store their organizer's displayName; for older ones that
+        do not yet, names maps organizerUserId to displayName, or when None
+        the missing organizers are looked up with one cached get_multi.
+        """
+        forms = serializers.serializeMulti(confs, ConferenceForm)
+        missing = [cf for cf in forms if cf.organizerDisplayName is None]
+        if missing and names is None:
+            user_ids = list(set(cf.organizerUserId for cf in missing))
+            profiles = cache.getMulti([ndb.Key(Profile, user_id) for user_id in user_ids])
+            names = dict((user_id, prof.displayName)
+                         for user_id, prof in zip(user_ids, profiles) if prof)
+        for cf in missing:
+            displayName = names.get(cf.organizerUserId)
+            if displayName:
+                cf.organizerDisplayName = displayName
+        return forms
+
+
+    def _conferenceData(self, request):
+        """Validate a ConferenceForm and return the Conference properties
+        it sets, with defaults filled in (on the request too)."""
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
+        # outbound only, the Conference has no such properties
+        for name in ('websafeKey', 'etag', 'notModified'):
+            del data[name]
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -193,6 +335,19 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        data["seatShards"] = seats.seatShardCount(data["maxAttendees"])
+        return data
+
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        data = self._conferenceData(request)
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -200,18 +355,24 @@ class ConferenceApi(remote.Service):
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
-
-        # create Conference, send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        # stored with the conference so reads need no Profile lookup
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            self._getProfileFromUser().displayName
+
+        # create Conference with its seat shards, send email to organizer
+        # confirming creation of Conference & return (modified) ConferenceForm
+        conf = Conference(**data)
+        unitofwork.putMulti([conf] + seats.buildSeatShards(
+            c_key, conf.seatsAvailable, conf.seatShards))
+        announcements.onCommitSeatsChanged(conf, None)
+        unitofwork.callOnFlush(lambda: textindex.scheduleIndexing([c_key]))
+        email = user.email()
+        unitofwork.callOnFlush(
+            lambda: confirmations.queueConfirmation(email, [c_key]))
         return request
 
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -233,9 +394,15 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        oldSeats = conf.seatsAvailable
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
+            # the organizer's name follows their Profile, not the request;
+            # the rest are outbound only
+            if field.name in ('organizerDisplayName', 'websafeKey', 'etag',
+                              'notModified'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -246,13 +413,23 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        # an explicit seatsAvailable replaces whatever the seat shards hold
+        if request.seatsAvailable is not None:
+            seats.resetSeats(conf, request.seatsAvailable)
+        versions.touch(conf)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cache.invalidate(conf.key)
+        versions.bump(versions.conference(conf.key))
+        # seats or the name may have changed the announcement
+        announcements.onCommitSeatsChanged(conf, oldSeats)
+        textindex.scheduleIndexing([conf.key], transactional=True)
+        return self._copyConferenceToForm(conf)
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -261,29 +438,50 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    def _ifNoneMatch(self, request):
+        """Return the request's ifNoneMatch parameter, else its
+        If-None-Match header."""
+        if request.ifNoneMatch:
+            return request.ifNoneMatch
+        headers = getattr(getattr(self, 'request_state', None), 'headers', None)
+        return headers.get('If-None-Match') if headers else None
+
+
+    @endpoints.method(CONF_ETAG_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumentation.instrumented
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
+        """Return requested conference (by websafeConferenceKey), or
+        notModified if it still matches ifNoneMatch."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        etag = versions.etag([versions.conference(c_key)])
+        if versions.matches(etag, self._ifNoneMatch(request)):
+            return ConferenceForm(etag=etag, notModified=True)
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = cache.get(c_key)
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        # report the live seat count summed over the seat shards
+        conf.seatsAvailable = seats.getSeatsAvailable(conf)
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf)
+        cf.etag = etag
+        return cf
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(PAGE_GET_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumentation.instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -294,83 +492,64 @@ class ConferenceApi(remote.Service):
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs, nextPageToken = self._fetchPage(confs, request)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=self._copyConferencesToForms(confs),
+            nextPageToken=nextPageToken
         )
 
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
-
-
-    def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
-        formatted_filters = []
-        inequality_field = None
-
-        for f in filters:
-            filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
-
-            try:
-                filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
-            except KeyError:
-                raise endpoints.BadRequestException("Filter contains invalid field or operator.")
-
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
-            formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        """Plan the query for the submitted filters; returns the Plan (see
+        conferencequery) and the number of candidate plans considered."""
+        try:
+            filters = conferencequery.parseFilters(request.filters)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        return conferencequery.planConferenceQuery(filters)
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumentation.instrumented
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        """Query for conferences; with explain set, return the query plan
+        instead of running it."""
+        plan, candidates = self._getQuery(request)
+        if request.explain:
+            explained = plan.describe()
+            explained['candidatePlans'] = candidates
+            return ConferenceForms(queryPlan=json.dumps(explained))
+
+        # conferences that predate the stored organizerDisplayName need it
+        # from the Profile; start one (batched) lookup per distinct organiser
+        # as each such conference arrives
+        organisers = {}
+        def lookupOrganiser(conf):
+            if (conf.organizerDisplayName is None and
+                    conf.organizerUserId not in organisers):
+                organisers[conf.organizerUserId] = \
+                    ndb.Key(Profile, conf.organizerUserId).get_async()
+
+        # single pass over the query
+        conferences, nextPageToken = self._fetchPageAsync(
+            plan.query(), request, lookupOrganiser,
+            plan.predicate()).get_result()
 
         # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        names = self._organiserNames(organisers)
 
-        # return individual ConferenceForm object per Conference
+        # return individual ConferenceForm object per Conference; forms of
+        # conferences that need their organiser's Profile are not cached
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+                items=fragments.serializeMulti(
+                    conferences, ConferenceForm,
+                    lambda confs: self._copyConferencesToForms(confs, names),
+                    lambda conf: conf.organizerDisplayName is not None),
+                nextPageToken=nextPageToken
         )
 
 
@@ -379,15 +558,11 @@ class ConferenceApi(remote.Service):
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
         # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
+        pf = serializers.serialize(prof, ProfileForm)
+        # registrations and the wishlist are kept in child entities, not on
+        # the Profile
+        pf.conferenceKeysToAttend = self._getConferenceKeysToAttend(prof)
+        pf.sessionKeysWishlist = self._getSessionKeysWishlist(prof)
         return pf
 
 
@@ -401,7 +576,7 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = cache.get(p_key)
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -410,7 +585,7 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            unitofwork.put(profile)
 
         return profile      # return Profile
 
@@ -421,7 +596,9 @@ class ConferenceApi(remote.Service):
         prof = self._getProfileFromUser()
 
         # if saveProfile(), process user-modifyable fields
+        displayName = prof.displayName
         if save_request:
+            changed = False
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -431,21 +608,83 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        changed = True
+            if changed:
+                versions.touch(prof)
+                unitofwork.put(prof)
+                cache.invalidate(prof.key)
+                versions.bump(versions.profile(prof.key))
+
+            # conferences keep a copy of the organizer's name; rewrite
+            # them in the background, once the new name is stored
+            if prof.displayName != displayName:
+                user_id = prof.key.id()
+                unitofwork.callOnFlush(lambda: taskqueue.add(
+                    params={'userId': user_id},
+                    url='/tasks/update_organizer_name'
+                ))
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @staticmethod
+    @ndb.transactional()
+    def _setOrganizerName(c_keys, displayName):
+        """Set organizerDisplayName on a batch of one organizer's Conferences
+        (a single entity group), writing only those that differ."""
+        confs = [conf for conf in ndb.get_multi(c_keys)
+                 if conf and conf.organizerDisplayName != displayName]
+        for conf in confs:
+            conf.organizerDisplayName = displayName
+        versions.touch(*confs)
+        ndb.put_multi(confs)
+        cache.invalidate(*[conf.key for conf in confs])
+        versions.bump(*[versions.conference(conf.key) for conf in confs])
+
+
+    @staticmethod
+    def _updateOrganizerNameBatch(user_id, cursor=None):
+        """Copy an organizer's current displayName onto one page of their
+        Conferences and queue a task for the next page; used by the
+        organizer name task handler."""
+        p_key = ndb.Key(Profile, user_id)
+        prof = p_key.get()
+        if not prof:
+            return
+        start = Cursor(urlsafe=cursor) if cursor else None
+        c_keys, nextCursor, more = Conference.query(ancestor=p_key).fetch_page(
+            ORGANIZER_NAME_BATCH_SIZE, start_cursor=start, keys_only=True)
+        if c_keys:
+            ConferenceApi._setOrganizerName(c_keys, prof.displayName)
+        if more and nextCursor:
+            taskqueue.add(params={'userId': user_id, 'cursor': nextCursor.urlsafe()},
+                url='/tasks/update_organizer_name'
+            )
+
+
+    @endpoints.method(ETAG_GET_REQUEST, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def getProfile(self, request):
-        """Return user profile."""
-        return self._doProfile()
+        """Return user profile, or notModified if it still matches
+        ifNoneMatch."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        etag = versions.etag([versions.profile(ndb.Key(Profile, getUserId(user)))])
+        if versions.matches(etag, self._ifNoneMatch(request)):
+            return ProfileForm(etag=etag, notModified=True)
+        pf = self._doProfile()
+        pf.etag = etag
+        return pf
 
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -455,39 +694,93 @@ class ConferenceApi(remote.Service):
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Reconcile the nearly sold out set & its cached announcement;
+        used by the announcement cron job.
+
+        The set is kept up to date as seats change, so this is only a
+        safety net for updates lost to a failed task or memcache eviction.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+        # seatsAvailable on the entity lags the shards by a few seconds,
+        # so use it (and the current set) to find candidates and the shard
+        # sums to confirm them
+        c_keys = set(Conference.query(ndb.AND(
+            Conference.seatsAvailable <= announcements.NEARLY_SOLD_OUT_SEATS,
             Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        ).fetch(keys_only=True))
+        c_keys.update(announcements.nearlySoldOutKeys())
+        confs = [conf for conf in cache.getMulti(list(c_keys)) if conf]
+        seatsAvailable = seats.getSeatsAvailableMulti(confs)
 
-        return announcement
+        return announcements.resetNearlySoldOut(dict(
+            (conf.key.urlsafe(), conf.name) for conf in confs
+            if announcements.isNearlySoldOut(seatsAvailable.get(conf.key))))
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumentation.instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return StringMessage(data=announcements.getAnnouncement())
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfile(p_key):
+        """Move a Profile's legacy conferenceKeysToAttend and
+        sessionKeysWishlist lists into Registration and WishlistEntry
+        entities; returns the (updated) Profile."""
+        prof = p_key.get()
+        if prof and (prof.conferenceKeysToAttend or prof.sessionKeysWishlist):
+            entities = [Registration(key=ndb.Key(Registration, wsck, parent=p_key),
+                                     conferenceKey=ndb.Key(urlsafe=wsck))
+                        for wsck in set(prof.conferenceKeysToAttend)]
+            entities += [WishlistEntry(key=ndb.Key(WishlistEntry, wssk, parent=p_key),
+                                       sessionKey=ndb.Key(urlsafe=wssk))
+                         for wssk in set(prof.sessionKeysWishlist)]
+            prof.conferenceKeysToAttend = []
+            prof.sessionKeysWishlist = []
+            versions.touch(prof)
+            ndb.put_multi(entities + [prof])
+            cache.invalidate(p_key)
+            versions.bump(versions.profile(p_key))
+        return prof
+
+
+    @staticmethod
+    def _isLegacyProfile(prof):
+        """Return True if the Profile still holds lists to be migrated."""
+        return bool(prof.conferenceKeysToAttend or prof.sessionKeysWishlist)
+
+
+    @staticmethod
+    def _migrateProfilesBatch(cursor=None):
+        """Migrate one page of Profiles to Registration and WishlistEntry
+        entities and queue a task for the next page; used by the migration
+        task handler."""
+        start = Cursor(urlsafe=cursor) if cursor else None
+        profs, nextCursor, more = Profile.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=start)
+        for prof in profs:
+            if ConferenceApi._isLegacyProfile(prof):
+                ConferenceApi._migrateProfile(prof.key)
+        if more and nextCursor:
+            taskqueue.add(params={'cursor': nextCursor.urlsafe()},
+                url='/tasks/migrate_profiles'
+            )
+
+
+    def _getConferenceKeysToAttend(self, prof):
+        """Return the websafe keys of the conferences the user registered for."""
+        # keys only: the conference key is the Registration's key name
+        regs = Registration.query(ancestor=prof.key).fetch(keys_only=True)
+        # include entries not yet migrated from the legacy list
+        return [reg.id() for reg in regs] + prof.conferenceKeysToAttend
+
+
     @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
@@ -502,68 +795,92 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        # seats live in shards; split them out on first use for old conferences
+        if not conf.seatShards:
+            conf = seats.ensureSeatShards(conf.key)
+
+        # registrations live in Registration entities; move legacy ones over
+        if self._isLegacyProfile(prof):
+            prof = self._migrateProfile(prof.key)
+
+        # membership is a single key lookup
+        reg_key = ndb.Key(Registration, wsck, parent=prof.key)
+        registered = reg_key.get() is not None
+
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registered:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # take away one seat, if there are any left
+            if not seats.takeSeat(conf):
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
+            # register user
+            Registration(key=reg_key, conferenceKey=conf.key).put()
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registered:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
+                reg_key.delete()
+                seats.returnSeat(conf)
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # neither the Profile nor the Conference is rewritten: the change
+        # went to the small Registration entity and a seat shard (which
+        # bumps the Conference's generation)
+        if retval:
+            versions.bump(versions.profile(prof.key))
         return BooleanMessage(data=retval)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(ETAG_GET_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumentation.instrumented
     def getConferencesToAttend(self, request):
-        """Get list of conferences that user has registered for."""
+        """Get list of conferences that user has registered for, or
+        notModified if it still matches ifNoneMatch."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        # the Profile's generation covers the registrations, so read it
+        # before them
+        profileEtag = versions.etag(
+            [versions.profile(ndb.Key(Profile, getUserId(user)))])
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        if self._isLegacyProfile(prof):
+            prof = self._migrateProfile(prof.key)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # keys only query, the conference key is the Registration's key name
+        c_keys = [ndb.Key(urlsafe=wsck)
+                  for wsck in self._getConferenceKeysToAttend(prof)]
+        etag = profileEtag and versions.etag(
+            [versions.conference(c_key) for c_key in c_keys], profileEtag)
+        if versions.matches(etag, self._ifNoneMatch(request)):
+            return ConferenceForms(etag=etag, notModified=True)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
-
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        # one cached get_multi for the conferences; organisers of ones that
+        # predate the stored organizerDisplayName are looked up in one more
+        conferences = [conf for conf in cache.getMulti(c_keys) if conf]
+        return ConferenceForms(items=self._copyConferencesToForms(conferences),
+                               etag=etag)
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -572,6 +889,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
@@ -580,6 +899,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @instrumentation.instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -593,7 +913,7 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.month==6)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=self._copyConferencesToForms(q, {})
         )
 
 
@@ -601,55 +921,65 @@ class ConferenceApi(remote.Service):
     
     def _copySessionToForm(self, session):
         """Copy fields from Session object to SessionForm."""
-        sf = SessionForm()
-        wssk = session.key.urlsafe()
-        for field in sf.all_fields():
-            if hasattr(session, field.name):
-                # format date/time fields to string for form.
-                if field.name.endswith('Date') or field.name.endswith('Time'):
-                    setattr(sf, field.name, str(getattr(session, field.name)))
-                elif field.name == 'typeOfSession':
-                    # lookup value of enum type
-                    setattr(sf, field.name, getattr(TypeOfSession, getattr(session, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(session, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, wssk)
-        sf.check_initialized()
-        return sf
+        return serializers.serialize(session, SessionForm)
+
+
+    def _copySessionsToForms(self, sessions):
+        """Copy a list of Sessions to SessionForms in one pass."""
+        return serializers.serializeMulti(sessions, SessionForm)
+
+
+    def _copySessionsToFormsCached(self, sessions):
+        """Return SessionForms from the fragment cache, copying only the
+        misses; the forms are shared and must not be modified."""
+        return fragments.serializeMulti(sessions, SessionForm,
+                                        self._copySessionsToForms)
         
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(PAGE_GET_REQUEST, SessionForms,
         path='querySessions', http_method='GET', name='querySessions')
+    @instrumentation.instrumented
     def querySessions(self, request):
         """Get all Sessions."""
-        q = Session.query()
+        sessions, nextPageToken = self._fetchPage(Session.query(), request)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in q])
+            items=self._copySessionsToFormsCached(sessions),
+            nextPageToken=nextPageToken)
         
     
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_PAGE_GET_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/session',
         http_method='GET', name='getConferenceSessions')
+    @instrumentation.instrumented
     def getConferenceSessions(self, request):
-        """Get sessions for the Conference."""
+        """Get sessions for the Conference, or notModified if the page
+        still matches ifNoneMatch."""
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        c_key = ndb.Key(urlsafe=wsck)
+        etag = versions.etag([versions.sessions(c_key)],
+                             request.pageSize, request.pageToken)
+        if versions.matches(etag, self._ifNoneMatch(request)):
+            return SessionForms(etag=etag, notModified=True)
+        conf = cache.get(c_key)
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found for key: %s' % wsck)
         sessions = Session.query(ancestor=conf.key)
+        sessions, nextPageToken = self._fetchPage(sessions, request)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=self._copySessionsToFormsCached(sessions),
+            nextPageToken=nextPageToken,
+            etag=etag)
         
     
     @endpoints.method(CONF_SESS_GET_REQUEST, SessionForms,
         path='conference/{websafeConferenceKey}/session/type/{typeOfSession}',
         http_method='POST', name='getConferenceSessionsByType')
+    @instrumentation.instrumented
     def getConferenceSessionsByType(self, request):
         """For a Conference, return all Sessions that match the given type."""
         wsck = request.websafeConferenceKey
         sessType = request.typeOfSession
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = cache.get(ndb.Key(urlsafe=wsck))
         # check the provided key exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -658,29 +988,24 @@ class ConferenceApi(remote.Service):
         sessions = Session.query(ancestor=conf.key)
         sessions = sessions.filter(Session.typeOfSession == sessType)
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=self._copySessionsToForms(sessions))
 
 
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
         path='session/speaker/{speaker}',
         http_method='GET', name='getSessionsBySpeaker')
+    @instrumentation.instrumented
     def getSessionsBySpeaker(self, request):
         """Return SessionForms of sessions given by speaker"""
-        q = Session.query()
-        q = q.filter(Session.speaker == request.speaker)
+        # one keys-only index query, then one get_multi for the page
+        s_keys, nextPageToken = self._speakerPage(request)
+        sessions = [sess for sess in cache.getMulti(s_keys) if sess]
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in q])
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=nextPageToken)
     
-    def _createSessionObject(self, request):
-        """Create or Session object, returning SessionForm/request."""
-        wsck = request.websafeConferenceKey
-        
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    def _sessionData(self, request):
+        """Validate a SessionForm and return the Session properties it sets."""
         # validate the required fields are entered.
         if not request.name:
             raise endpoints.BadRequestException("Session 'name' field required")
@@ -707,10 +1032,24 @@ class ConferenceApi(remote.Service):
         
         # remove the values we dont need anymore from the collection
         del data['websafeKey']
-        del data['websafeConferenceKey']
+        data.pop('websafeConferenceKey', None)
+        return data
+
+
+    def _createSessionObject(self, request):
+        """Create or Session object, returning SessionForm/request."""
+        wsck = request.websafeConferenceKey
+        
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        data = self._sessionData(request)
 
         # load the conference the session is to be created for.
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = cache.get(ndb.Key(urlsafe=wsck))
 
         # confirm the conference is valid.
         if not conf:
@@ -729,12 +1068,15 @@ class ConferenceApi(remote.Service):
         s_key = ndb.Key(Session, s_id, parent=c_key)
         data['key'] = s_key
         
-        wssk = Session(**data).put().urlsafe()
-        sess = ndb.Key(urlsafe=wssk).get()
+        sess = Session(**data)
+        self._storeSession(sess)
+        cache.invalidate(s_key)
+        versions.bump(versions.sessions(c_key))
+        timetable.addSession(sess)
         
-        taskqueue.add(params={'websafeConferenceKey': wsck,
-                              'websafeSessionKey': wssk},
-                              url='/tasks/set_featured_speaker')
+        # a burst of new sessions shares one recomputation
+        self._scheduleFeaturedSpeaker([wsck])
+        textindex.scheduleIndexing([s_key])
         
         return self._copySessionToForm(sess)
     
@@ -742,163 +1084,511 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_SESS_POST_REQUEST, SessionForm,
         path='conference/{websafeConferenceKey}/session',
         http_method='POST', name='createSession')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def createSession(self, request):
         """Create new Session for a Conference"""
         return self._createSessionObject(request)
         
+
+# - - - Bulk import - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _putByEntityGroup(entities):
+        """Put entities in rounds that write at most IMPORT_BATCH_SIZE
+        entities of any one entity group, so each group sees one write per
+        round however many entities it gets."""
+        groups = {}
+        for entity in entities:
+            groups.setdefault(entity.key.root(), []).append(entity)
+        chunks = [[group[i:i + IMPORT_BATCH_SIZE]
+                   for i in range(0, len(group), IMPORT_BATCH_SIZE)]
+                  for group in groups.values()]
+        for batch in itertools.izip_longest(*chunks):
+            futures = [future for chunk in batch if chunk
+                       for future in ndb.put_multi_async(chunk)]
+            ndb.Future.wait_all(futures)
+            for future in futures:
+                future.check_success()
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _countImportedSessions(c_key, sessions):
+        """Count Sessions imported into an existing Conference in its
+        SpeakerTally."""
+        t_key = ConferenceApi._speakerTallyKey(c_key)
+        tally = t_key.get()
+        if tally is None:
+            # first tally for this conference; the query sees the new
+            # sessions too
+            tally = SpeakerTally(key=t_key, sessionNames={})
+            sessions = Session.query(ancestor=c_key)
+        for sess in sessions:
+            ConferenceApi._countSpeakerSession(tally, sess.speaker, sess.name)
+        tally.put()
+
+
+    def _bulkImport(self, request):
+        """Create Conferences and Sessions in bulk: one id allocation per
+        parent, entity-group-batched puts and one featured speaker task per
+        Conference."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        imports = request.conferences
+        if len(imports) > MAX_IMPORT_CONFERENCES:
+            raise endpoints.BadRequestException(
+                'At most %d conferences per import' % MAX_IMPORT_CONFERENCES)
+        if sum(len(imp.sessions) for imp in imports) > MAX_IMPORT_SESSIONS:
+            raise endpoints.BadRequestException(
+                'At most %d sessions per import' % MAX_IMPORT_SESSIONS)
+
+        # validate everything before writing anything
+        existing = [ndb.Key(urlsafe=imp.websafeConferenceKey)
+                    for imp in imports if imp.websafeConferenceKey]
+        for c_key, conf in zip(existing, cache.getMulti(existing)):
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % c_key.urlsafe())
+            if conf.organizerUserId != user_id:
+                raise endpoints.ForbiddenException(
+                    'Only the owner can import into the conference.')
+        for imp in imports:
+            if not imp.websafeConferenceKey and not imp.conference:
+                raise endpoints.BadRequestException(
+                    "Each import needs a 'conference' or 'websafeConferenceKey'")
+        confData = [self._conferenceData(imp.conference)
+                    for imp in imports if not imp.websafeConferenceKey]
+        sessData = [[self._sessionData(sess) for sess in imp.sessions]
+                    for imp in imports]
+
+        # one id range for the new conferences...
+        prof = self._getProfileFromUser()
+        p_key = prof.key
+        c_ids = iter([])
+        if confData:
+            first, last = Conference.allocate_ids(size=len(confData), parent=p_key)
+            c_ids = iter(range(first, last + 1))
+        c_keys = [ndb.Key(urlsafe=imp.websafeConferenceKey)
+                  if imp.websafeConferenceKey
+                  else ndb.Key(Conference, next(c_ids), parent=p_key)
+                  for imp in imports]
+        # ... and one per conference for its sessions, all in parallel
+        s_ranges = [Session.allocate_ids_async(size=len(data), parent=c_key)
+                    if data else None
+                    for c_key, data in zip(c_keys, sessData)]
+
+        entities, newConfs = [], []
+        newKeys = [c_key for imp, c_key in zip(imports, c_keys)
+                   if not imp.websafeConferenceKey]
+        for c_key, data in zip(newKeys, confData):
+            data['key'] = c_key
+            data['organizerUserId'] = user_id
+            data['organizerDisplayName'] = prof.displayName
+            conf = Conference(**data)
+            newConfs.append(conf)
+            entities.append(conf)
+            entities.extend(seats.buildSeatShards(
+                c_key, conf.seatsAvailable, conf.seatShards))
+
+        results, bySpeaker, existingSessions = [], {}, []
+        for imp, c_key, data, s_range in zip(imports, c_keys, sessData, s_ranges):
+            sessions = []
+            if s_range:
+                first, last = s_range.get_result()
+                sessions = [Session(key=ndb.Key(Session, s_id, parent=c_key), **d)
+                            for s_id, d in zip(range(first, last + 1), data)]
+            entities.extend(sessions)
+            for sess in sessions:
+                bySpeaker.setdefault(speakers.normalizeSpeakerName(sess.speaker),
+                                     (sess.speaker, []))[1].append(sess.key)
+            if imp.websafeConferenceKey:
+                if sessions:
+                    existingSessions.append((c_key, sessions))
+            elif sessions:
+                # a new conference's tally is written with its sessions
+                tally = SpeakerTally(key=self._speakerTallyKey(c_key),
+                                     sessionNames={})
+                for sess in sessions:
+                    self._countSpeakerSession(tally, sess.speaker, sess.name)
+                entities.append(tally)
+            results.append(BulkImportResultForm(
+                websafeConferenceKey=c_key.urlsafe(),
+                websafeSessionKeys=[sess.key.urlsafe() for sess in sessions]))
+
+        self._putByEntityGroup(entities)
+        for c_key, sessions in existingSessions:
+            self._countImportedSessions(c_key, sessions)
+            timetable.invalidate(sessions)
+            versions.bump(versions.sessions(c_key))
+        # the speaker index entries, one put per speaker
+        for speaker, s_keys in bySpeaker.values():
+            speakers.addSpeakerSessions(speaker, s_keys)
+        for conf in newConfs:
+            announcements.onCommitSeatsChanged(conf, None)
+
+        # one featured speaker recomputation per conference, text index
+        # updates in INDEX_BATCH_SIZE slices queued in bulk, and a single
+        # confirmation email
+        self._scheduleFeaturedSpeaker([result.websafeConferenceKey
+                                       for result in results
+                                       if result.websafeSessionKeys])
+        tasks = [task for result in results
+                 for task in textindex.indexingTasks(
+                     [result.websafeConferenceKey] + result.websafeSessionKeys)]
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        if newConfs:
+            confirmations.queueConfirmation(user.email(), newKeys)
+        return BulkImportResultForms(items=results)
+
+
+    @endpoints.method(BulkImportForm, BulkImportResultForms,
+        path='bulkImport',
+        http_method='POST', name='bulkImport')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
+    def bulkImport(self, request):
+        """Create many Conferences and/or Sessions in one call."""
+        return self._bulkImport(request)
+
+
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _search(self, kind, request):
+        """Return (entities, nextPageToken) for one page of a full-text
+        search, best matches first."""
+        if not request.query:
+            raise endpoints.BadRequestException("'query' field required")
+        pageSize = request.pageSize or DEFAULT_PAGE_SIZE
+        if pageSize < 1 or pageSize > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                "pageSize must be between 1 and %d" % MAX_PAGE_SIZE)
+        try:
+            results, nextPageToken = textindex.search(
+                kind, request.query, pageSize, request.pageToken)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        # postings of a just deleted document may outlive it briefly
+        entities = [entity for entity in
+                    cache.getMulti([key for key, _ in results]) if entity]
+        return entities, nextPageToken
+
+
+    @endpoints.method(SEARCH_GET_REQUEST, ConferenceForms,
+        path='search/conferences',
+        http_method='GET', name='searchConferences')
+    @instrumentation.instrumented
+    def searchConferences(self, request):
+        """Return conferences whose name, description, city or topics
+        contain every word of the query (at most five, stop words aside)."""
+        confs, nextPageToken = self._search('Conference', request)
+        return ConferenceForms(
+            items=self._copyConferencesToForms(confs),
+            nextPageToken=nextPageToken)
+
+
+    @endpoints.method(SEARCH_GET_REQUEST, SessionForms,
+        path='search/sessions',
+        http_method='GET', name='searchSessions')
+    @instrumentation.instrumented
+    def searchSessions(self, request):
+        """Return sessions whose name, description, highlights, speaker or
+        type contain every word of the query (at most five, stop words
+        aside)."""
+        sessions, nextPageToken = self._search('Session', request)
+        return SessionForms(
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=nextPageToken)
+
     
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    def _querySessionsFiltered(self, request, types, startTimeFrom=None,
+                               startTimeBefore=None, dateFrom=None, dateTo=None,
+                               ancestor=None):
+        """Return a page of SessionForms matching the session predicates."""
+        q, predicate = sessionquery.buildSessionQuery(
+            types, startTimeFrom, startTimeBefore, dateFrom, dateTo, ancestor)
+        if q is None:
+            return SessionForms(items=[])
+        sessions, nextPageToken = self._fetchPageAsync(
+            q, request, predicate=predicate).get_result()
+        return SessionForms(
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=nextPageToken)
+
+
+    @endpoints.method(SessionQueryForm, SessionForms,
+        path='querySessionsAdvanced',
+        http_method='POST', name='querySessionsAdvanced')
+    @instrumentation.instrumented
+    def querySessionsAdvanced(self, request):
+        """Query sessions by type (included and/or excluded), start time
+        window and date range, optionally within one conference."""
+        types = sessionquery.allowedSessionTypes(
+            [str(t) for t in request.typeOfSession],
+            [str(t) for t in request.excludeTypeOfSession])
+        try:
+            startTimeFrom, startTimeBefore = [
+                datetime.strptime(t[:5], "%H:%M").time() if t else None
+                for t in (request.startTimeFrom, request.startTimeBefore)]
+            dateFrom, dateTo = [
+                datetime.strptime(d[:10], "%Y-%m-%d").date() if d else None
+                for d in (request.sessionDateFrom, request.sessionDateTo)]
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Times must be HH:MM and dates YYYY-MM-DD")
+
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        return self._querySessionsFiltered(
+            request, types, startTimeFrom, startTimeBefore, dateFrom, dateTo,
+            ancestor)
+        
+
+    @endpoints.method(PAGE_GET_REQUEST, SessionForms,
         path='queryNonWorkshopSessionsBefore7pm',
         http_method='GET', name='queryNonWorkshopSessionsBefore7pm')
+    @instrumentation.instrumented
     def queryNonWorkshopSessionsBefore7pm(self, request):
         """Get all non workshop sessions, with start time prior to 19:00"""
         latestStart = datetime.strptime('19:00', "%H:%M").time()
-        sessions = Session.query(Session.startTime < latestStart)
-        nonWorkshopSessions = [sess for sess in sessions
-                               if sess.typeOfSession != 'WORKSHOP']
-        return SessionForms(
-            items = [self._copySessionToForm(sess) for sess in nonWorkshopSessions]
-        )
+        # the datastore runs one startTime query per non workshop type
+        types = sessionquery.allowedSessionTypes(exclude=['WORKSHOP'])
+        return self._querySessionsFiltered(
+            request, types, startTimeBefore=latestStart)
         
         
 # - - - - - - - Wishlist - - - - - - - -
+    def _getSessionsInWishlist(self, prof):
+        """Return the wishlisted Sessions of a Profile, skipping dangling keys."""
+        # keys only query, the session key is the WishlistEntry's key name
+        entries = WishlistEntry.query(ancestor=prof.key).fetch(keys_only=True)
+        sessions = cache.getMulti([ndb.Key(urlsafe=entry.id()) for entry in entries])
+        return [session for session in sessions if session]
+
+
+    def _getSessionKeysWishlist(self, prof):
+        """Return the websafe keys of the Sessions on the user's wishlist."""
+        entries = WishlistEntry.query(ancestor=prof.key).fetch(keys_only=True)
+        # include entries not yet migrated from the legacy list
+        return [entry.id() for entry in entries] + prof.sessionKeysWishlist
+
+
+    def _getWishlistProfile(self):
+        """Return the user Profile, with its legacy wishlist migrated."""
+        prof = self._getProfileFromUser()
+        if self._isLegacyProfile(prof):
+            prof = self._migrateProfile(prof.key)
+        return prof
+
+
+    def _addSessionsToWishlist(self, prof, websafeSessionKeys):
+        """Add existing Sessions to the user's wishlist; one get_multi for the
+        Sessions and one put_multi for the new WishlistEntries."""
+        s_keys = []
+        for wssk in websafeSessionKeys:
+            s_key = ndb.Key(urlsafe=wssk)
+            if s_key.kind() != 'Session':
+                raise endpoints.BadRequestException(
+                    'Not a valid Session key: %s' % wssk)
+            s_keys.append(s_key)
+
+        for wssk, session in zip(websafeSessionKeys, cache.getMulti(s_keys)):
+            if not session:
+                raise endpoints.NotFoundException(
+                    'No Session found for key: %s' % wssk)
+
+        # the entry key is derived from the session key, so re-adding a
+        # session just overwrites its (tiny) entry; written at once rather
+        # than through the unit of work, as the returned form queries them
+        ndb.put_multi([WishlistEntry(key=ndb.Key(WishlistEntry, wssk, parent=prof.key),
+                                     sessionKey=s_key)
+                       for wssk, s_key in zip(websafeSessionKeys, s_keys)])
+        versions.bump(versions.profile(prof.key))
+
+
+    def _deleteSessionsInWishlist(self, prof, websafeSessionKeys):
+        """Remove Sessions from the user's wishlist; returns True if any of
+        them were on it."""
+        e_keys = [ndb.Key(WishlistEntry, wssk, parent=prof.key)
+                  for wssk in set(websafeSessionKeys)]
+        e_keys = [entry.key for entry in ndb.get_multi(e_keys) if entry]
+        ndb.delete_multi(e_keys)
+        if e_keys:
+            versions.bump(versions.profile(prof.key))
+        return bool(e_keys)
+
+
     @endpoints.method(SESS_POST_REQUEST, ProfileForm,
         path='session/{websafeSessionKey}',
         http_method='POST', name='addSessionToWishlist')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def addSessionToWishlist(self, request):
         """Add a Session to the users wishlist."""
-        prof = self._getProfileFromUser()
-        wssk = request.websafeSessionKey
-        session = ndb.Key(urlsafe=wssk)
-        if session.kind() != 'Session':
-            raise endpoints.BadRequestException(
-                'Not a valid Session key: %s' % wssk)
-        else:
-            session.get()
-            
-        if not session:
-            raise endpoints.NotFoundException(
-                'No Session found for key: %s' % wssk)
+        prof = self._getWishlistProfile()
+        self._addSessionsToWishlist(prof, [request.websafeSessionKey])
+        return self._copyProfileToForm(prof)
 
-        if wssk not in prof.sessionKeysWishlist:
-            prof.sessionKeysWishlist.append(wssk)
-            prof.put()
-            
+
+    @endpoints.method(WishlistForm, ProfileForm,
+        path='wishlist/add',
+        http_method='POST', name='addSessionsToWishlist')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
+    def addSessionsToWishlist(self, request):
+        """Add several Sessions to the users wishlist."""
+        prof = self._getWishlistProfile()
+        self._addSessionsToWishlist(prof, request.websafeSessionKeys)
         return self._copyProfileToForm(prof)
 
         
     @endpoints.method(message_types.VoidMessage, SessionForms,
         path='getSessionsInWishlist',
         http_method='GET', name='getSessionsInWishlist')
+    @instrumentation.instrumented
     def getSessionsInWishlist(self, request):
         """Get sessions in wishlist."""
-        prof = self._getProfileFromUser()
-        sessions = [ndb.Key(urlsafe=wssk).get() for wssk in prof.sessionKeysWishlist]
+        prof = self._getWishlistProfile()
         return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions])
+            items=self._copySessionsToForms(self._getSessionsInWishlist(prof)))
             
     
     @endpoints.method(SESS_DELETE_REQUEST, BooleanMessage,
         path='session/{websafeSessionKey}',
         http_method='DELETE', name='deleteSessionInWishlist')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
     def deleteSessionInWishlist(self, request):
         """Delete the session from the user's wishlist."""
-        prof = self._getProfileFromUser()
-        wssk = request.websafeSessionKey
-        # check if session exists in user's wishlist
-        if wssk in prof.sessionKeysWishlist:
-            # remove the session key from the wishlist
-            prof.sessionKeysWishlist.remove(wssk)
-            retval = True
-            prof.put()
-        else:
-            # session key not in users wishlist, return value is false.
-            retval = False
-        # write back the changes to the datastore
-
+        prof = self._getWishlistProfile()
+        # False if the session key was not in the user's wishlist
+        retval = self._deleteSessionsInWishlist(prof, [request.websafeSessionKey])
         return BooleanMessage(data=retval)
 
+
+    @endpoints.method(WishlistForm, ProfileForm,
+        path='wishlist/delete',
+        http_method='POST', name='deleteSessionsInWishlist')
+    @instrumentation.instrumented
+    @unitofwork.unitOfWork
+    def deleteSessionsInWishlist(self, request):
+        """Delete several sessions from the user's wishlist."""
+        prof = self._getWishlistProfile()
+        self._deleteSessionsInWishlist(prof, request.websafeSessionKeys)
+        return self._copyProfileToForm(prof)
+
 # - - - - - Speaker - - - - - - 
     @staticmethod
-    def _calculateFeaturedSpeaker(wsck, wssk):
-        """Upon adding a new session, check if the new speaker should be the keynote."""
-        # load the conference and session objects from websafe keys.
-        conf = ndb.Key(urlsafe=wsck).get()
-        sess = ndb.Key(urlsafe=wssk).get()
-        
-        # retrieve the current keynote speaker from memcache
+    def _speakerTallyKey(conf_key):
+        """Return the key of a Conference's SpeakerTally."""
+        return ndb.Key(SpeakerTally, SPEAKER_TALLY_ID, parent=conf_key)
+
+
+    @staticmethod
+    def _countSpeakerSession(tally, speaker, sessionName):
+        """Add a session to the tally; the speaker becomes featured once they
+        have more sessions than the current featured speaker."""
+        names = tally.sessionNames.setdefault(speaker, [])
+        names.append(sessionName)
+        featured = tally.featuredSpeaker
+        if not featured or len(names) > len(tally.sessionNames.get(featured, [])):
+            tally.featuredSpeaker = speaker
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _storeSession(sess):
+        """Store a new Session, count it in its Conference's SpeakerTally
+        (both in the Conference's entity group) and add it to the speaker
+        index."""
+        t_key = ConferenceApi._speakerTallyKey(sess.key.parent())
+        tally = t_key.get()
+        if tally is None:
+            # first tally for this conference, count the sessions stored so far
+            tally = SpeakerTally(key=t_key, sessionNames={})
+            for ss in Session.query(ancestor=sess.key.parent()):
+                ConferenceApi._countSpeakerSession(tally, ss.speaker, ss.name)
+        ConferenceApi._countSpeakerSession(tally, sess.speaker, sess.name)
+        ndb.put_multi([sess, tally])
+        speakers.addSpeakerSessions(sess.speaker, [sess.key])
+
+
+    @staticmethod
+    def _featuredSpeakerAnnouncement(tally):
+        """Return {speakerName}|[{session.name},] for the featured speaker,
+        or None if the conference has no sessions yet."""
+        if not tally or not tally.featuredSpeaker:
+            return None
+        speaker = tally.featuredSpeaker
+        return '|'.join((speaker, ','.join(tally.sessionNames[speaker])))
+
+
+    @staticmethod
+    def _scheduleFeaturedSpeaker(wscks):
+        """Queue one featured speaker recomputation per conference per
+        FEATURED_SPEAKER_DELAY window. The named task runs after its window
+        closes, so it sees every session added during the window."""
+        window = int(time.time()) // FEATURED_SPEAKER_DELAY
+        tasks = [taskqueue.Task(name='featured-%s-%d' % (wsck, window),
+                                params={'websafeConferenceKey': wsck},
+                                url='/tasks/set_featured_speaker',
+                                countdown=FEATURED_SPEAKER_DELAY)
+                 # one name may appear only once per add
+                 for wsck in sorted(set(wscks))]
+        queue = taskqueue.Queue()
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            try:
+                queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                # already scheduled for this window; the rest were added
+                pass
+
+
+    @staticmethod
+    def _calculateFeaturedSpeaker(wsck):
+        """Set the conference's featured (keynote) speaker announcement in
+        memcache from its SpeakerTally.
+
+        The tally is read after gets() and written back with cas(), so a
+        worker holding an older tally cannot overwrite a newer result.
+        """
         # key is CONF_FEAT_SPEAK_{wsck}
-        memSpeakerAnn = memcache.get('_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck)))
-        
-        # if there is no memcache entry add it for this conference.
-        if memSpeakerAnn is None:
-            # this is the initial session of the conference.
-            # pull out all of the sessions this speaker is giving
-            speakerSessions = Session.query(ancestor=conf.key)
-            speakerSessions.filter(Session.speaker == sess.speaker)
-            
-            # initialise the empty string
-            sessionsString = ''
-            
-            # iterate over all of the speakers sessions
-            for ss in speakerSessions:
-                # add the session name to the string
-                sessionsString += "%s," % (ss.name)
-            
-            sessionsString = sessionsString[:-1]
-            speakerAnnString = '|'.join((sess.speaker, sessionsString))
-            memcache.set('_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck)), speakerAnnString)
-        else:       
-            # retrieved string is {speakerName}|[{session.name},]
-            memSpeakerSplit = memSpeakerAnn.split('|')
-            
-            # load the split values from array into more readable variables
-            speakerFromMem = memSpeakerSplit[0]
-        
-            # speaker being added is different to the current keynote speaker,
-            # see who has the higher session count and set memcache appropriately.
-            if speakerFromMem != sess.speaker:
-                # if the speaker being added is different to the current keynote,
-                # check the counts of both
-            
-                # get the count of the newly added speaker
-                q1 = Session.query(ancestor=conf.key)
-                q1 = q1.filter(Session.speaker == sess.speaker)
-            
-                # get the count of the current keynote speaker
-                q2 = Session.query(ancestor=conf.key)
-                q2 = q2.filter(Session.speaker == speakerFromMem)
-            
-                # if the newly added sessions speaker has more sessions, set to be the keynote.
-                if q1.count > q2.count:
-                    # initialise an empty string to append each session to.
-                    sessionsString = ''
-            
-                    # iterate over all of the speakers sessions
-                    for ss in q1:
-                        # add the session name to the string
-                        sessionsString += "%s," % ss.name
-                
-                    # trim the trailing comma
-                    sessionsString = sessionsString[:-1]
-                    # join the speaker name and sessions
-                    speakerAnnString = '|'.join((sess.speaker, sessionsString))
-                    # set the memcache entry to the final announcement string for the speaker.
-                    memcache.set('_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck)), speakerAnnString)
-            else: 
-                # current speaker is already set to be featured. retreive the memcache string
-                # and append the new session name to the string with a leading comma.
-                memSpeakerAnn = memcache.get('_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck)))
-                memcache.set('_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck)), ','.join((memSpeakerAnn, sess.name)))
-                
+        key = '_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck))
+        t_key = ConferenceApi._speakerTallyKey(ndb.Key(urlsafe=wsck))
+        client = memcache.Client()
+        for _ in range(FEATURED_SPEAKER_CAS_RETRIES):
+            cached = client.gets(key)
+            # past the context cache, so each retry sees the latest tally
+            announcement = ConferenceApi._featuredSpeakerAnnouncement(
+                t_key.get(use_cache=False))
+            if not announcement or announcement == cached:
+                return announcement
+            if cached is None:
+                if client.add(key, announcement):
+                    return announcement
+            elif client.cas(key, announcement):
+                return announcement
+        # lost every race; the winners wrote a tally at least as new
+        return announcement
+
           
     @endpoints.method(CONF_GET_REQUEST, StringMessage,
         path='conference/{websafeConferenceKey}/featuredspeaker',
         http_method='GET', name='getFeaturedSpeaker')
+    @instrumentation.instrumented
     def getFeaturedSpeaker(self, request):
         """Return the featured (keynote) speaker for the conference."""
         wsck = request.websafeConferenceKey
         speaker = memcache.get('_'.join((MEMCACHE_FEATURED_SPEAKER_KEY, wsck)))
+        # memcache is only a cache, the SpeakerTally has the real answer
+        if speaker is None:
+            speaker = self._calculateFeaturedSpeaker(wsck)
         # this check helps incase this endpoint is hit before a session is added.
         if speaker is None:
             speaker = 'No keynote speaker.'
@@ -909,61 +1599,75 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESS_TYPE_GET_REQUEST, SessionForms,
         path='getAllSessionsByType',
         http_method='GET', name='getAllSessionsByType')
+    @instrumentation.instrumented
     def getAllSessionsByType(self, request):
         """Return all Sessions, regardless of Conference, optional filter by type and speaker"""
         
-        # open new query on Session
-        q = Session.query()
-        # apply speaker filter if provided
+        # with a speaker, read their sessions through the speaker index;
+        # a type filter applies to each page, which may then come up short
         if request.speaker is not None:
-            q = q.filter(Session.speaker == request.speaker)
-        # apply session type filter if provided
-        if request.typeOfSession is not None:
-            q = q.filter(Session.typeOfSession == request.typeOfSession)
-        # fetch the results
-        q = q.fetch()
+            s_keys, nextPageToken = self._speakerPage(request)
+            sessions = [sess for sess in cache.getMulti(s_keys) if sess and (
+                request.typeOfSession is None or
+                sess.typeOfSession == request.typeOfSession)]
+        else:
+            # open new query on Session
+            q = Session.query()
+            # apply session type filter if provided
+            if request.typeOfSession is not None:
+                q = q.filter(Session.typeOfSession == request.typeOfSession)
+            # fetch a page of the results
+            sessions, nextPageToken = self._fetchPage(q, request)
         # return the results as session forms objects to display.
         return SessionForms(
-            items=[self._copySessionToForm(sess)
-                   for sess in q])
+            items=self._copySessionsToForms(sessions),
+            nextPageToken=nextPageToken)
 
 
-    @endpoints.method(CONF_SESS_GET_REQUEST, SessionForms,
-        path='/conference/{websafeConferenceKey}/top',
-        http_method='GET', name='getTopSessionsForConference')
-    def getWorkshopsStartingSoonForConference(self, request):
-        """Return three sessions starting soon for a Conference"""
+    def _getConferenceForRequest(self, request):
+        """Return the Conference of the request's websafeConferenceKey."""
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
-        
+        conf = cache.get(ndb.Key(urlsafe=wsck))
         # check the provided conference exists.
         if not conf:
             raise endpoints.NotFoundException(
                 'Invalid Conference ID: %s' % wsck)
+        return conf
 
-        # Get current time.
-        currentTime = datetime.now().time()
-        # Get todays date in YYYY-MM-DD format
-        currentDate = datetime.now().date()
-        # set the times to zeroes in a string
-        tmpDateString = currentDate.strftime('%Y-%m-%d 00:00:00')
-        # convert back to a datetime value to compare against ndb dateproperty (time zeroed out)
-        currentDate = datetime.strptime(tmpDateString, '%Y-%m-%d %H:%M:%S')
-        
-        # find all WORKSHOPS for the conference starting today that haven't started yet.
-        q = Session.query(ancestor=conf.key)
-        q = q.filter(Session.sessionDate == currentDate)
-        # only filter on type if the parameter is entered.
-        if request.typeOfSession is not None:
-            q = q.filter(Session.typeOfSession == request.typeOfSession)
-        q = q.filter(Session.startTime > currentTime)
-        # order the results so the ones starting soon appear first
-        q = q.order(Session.startTime)
-        # only fetch the top results results.
-        q = q.fetch(3)
-
-        # provide the results back to the forms.
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in q])
-        
-        
-api = endpoints.api_server([ConferenceApi]) # register API
\ No newline at end of file
+
+    @endpoints.method(CONF_SESS_GET_REQUEST, SessionForms,
+        path='/conference/{websafeConferenceKey}/top',
+        http_method='GET', name='getTopSessionsForConference')
+    @instrumentation.instrumented
+    def getWorkshopsStartingSoonForConference(self, request):
+        """Return three sessions starting soon for a Conference"""
+        conf = self._getConferenceForRequest(request)
+        # the next sessions today, from the day's cached timetable
+        now = datetime.now()
+        sessions = timetable.startingAfter(
+            conf.key, now.date(), now.time(), STARTING_SOON_COUNT,
+            request.typeOfSession)
+        return SessionForms(items=self._copySessionsToForms(sessions))
+
+
+    @endpoints.method(CONF_DAY_GET_REQUEST, SessionForms,
+        path='conference/{websafeConferenceKey}/schedule',
+        http_method='GET', name='getConferenceSchedule')
+    @instrumentation.instrumented
+    def getConferenceSchedule(self, request):
+        """Return a Conference's sessions on a day (default today) by start
+        time, optionally of one type."""
+        conf = self._getConferenceForRequest(request)
+        day = datetime.now().date()
+        if request.date:
+            try:
+                day = datetime.strptime(request.date[:10], "%Y-%m-%d").date()
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "date must be YYYY-MM-DD: %s" % request.date)
+        sessions = timetable.daySessions(conf.key, day, request.typeOfSession)
+        return SessionForms(items=self._copySessionsToForms(sessions))
+
+
+api = instrumentation.measureResponses(
+    endpoints.api_server([ConferenceApi])) # register API
\ No newline at end of file
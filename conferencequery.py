@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""conferencequery.py
+
+Query planner for queryConferences. The datastore takes any number of
+equality filters (merge-joined on the built-in indexes). It takes at most
+one inequality property, and only with an index covering the equalities
+used alongside it. The planner enumerates the filter subsets it can push
+down given COMPOSITE_INDEXES and picks the one expected to read the fewest
+rows. The remaining filters are applied as a streaming predicate over the
+cursor-paged results.
+
+"""
+
+import itertools
+import operator
+
+from google.appengine.ext import ndb
+
+from models import Conference
+
+OPERATORS = {
+            'EQ':   '=',
+            'GT':   '>',
+            'GTEQ': '>=',
+            'LT':   '<',
+            'LTEQ': '<=',
+            'NE':   '!='
+            }
+
+FIELDS =    {
+            'CITY': 'city',
+            'TOPIC': 'topics',
+            'MONTH': 'month',
+            'MAX_ATTENDEES': 'maxAttendees',
+            }
+
+INTEGER_FIELDS = ('month', 'maxAttendees')
+# planning is exponential in the number of equality filters
+MAX_FILTERS = 8
+
+# the Conference composite indexes in index.yaml, as
+# (equality properties, inequality property)
+COMPOSITE_INDEXES = (
+    (('city',), 'month'),
+    (('city',), 'maxAttendees'),
+    (('topics',), 'month'),
+    (('topics',), 'maxAttendees'),
+)
+
+# rough share of conferences matching one equality filter on a field
+EQUALITY_SELECTIVITY = {
+    'city': 0.05,
+    'topics': 0.1,
+    'month': 1 / 12.0,
+    'maxAttendees': 0.02,
+}
+# value ranges used to estimate range filter selectivity
+VALUE_RANGES = {
+    'month': (1, 12),
+    'maxAttendees': (0, 1000),
+}
+RANGE_SELECTIVITY = 1 / 3.0
+NE_SELECTIVITY = 0.9
+
+_COMPARE = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Filter(object):
+    """One parsed filter: property name, datastore operator and value."""
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    @property
+    def isEquality(self):
+        return self.op == '='
+
+    def node(self):
+        """Return the ndb filter ("!=" becomes a "<" / ">" disjunction)."""
+        return ndb.query.FilterNode(self.field, self.op, self.value)
+
+    def matches(self, conf):
+        """Python twin of node(); like the datastore, a repeated property
+        matches if any of its values does."""
+        value = getattr(conf, self.field, None)
+        compare = _COMPARE[self.op]
+        return any(v is not None and compare(v, self.value)
+                   for v in (value if isinstance(value, list) else [value]))
+
+    def selectivity(self):
+        """Estimated share of conferences passing this filter."""
+        if self.isEquality:
+            return EQUALITY_SELECTIVITY.get(self.field, 0.1)
+        if self.op == '!=':
+            return NE_SELECTIVITY
+        if self.field not in VALUE_RANGES:
+            return RANGE_SELECTIVITY
+        low, high = VALUE_RANGES[self.field]
+        value = min(max(self.value, low), high)
+        if self.op in ('>', '>='):
+            share = (high - value) / float(high - low)
+        else:
+            share = (value - low) / float(high - low)
+        return min(max(share, 0.01), 1.0)
+
+    def __str__(self):
+        return '%s %s %r' % (self.field, self.op, self.value)
+
+
+def parseFilters(forms):
+    """Return Filters for ConferenceQueryForms; raises ValueError."""
+    if len(forms) > MAX_FILTERS:
+        raise ValueError("At most %d filters are allowed." % MAX_FILTERS)
+    filters = []
+    for form in forms:
+        try:
+            field = FIELDS[form.field]
+            op = OPERATORS[form.operator]
+        except KeyError:
+            raise ValueError("Filter contains invalid field or operator.")
+        value = form.value
+        if field in INTEGER_FIELDS:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError("Filter value for %s must be an integer." % form.field)
+        filters.append(Filter(field, op, value))
+    return filters
+
+
+class Plan(object):
+    """The filters pushed to the datastore, those streamed, and the index
+    that serves the datastore part."""
+
+    def __init__(self, pushed, streamed, inequalityField, index):
+        self.pushed = pushed
+        self.streamed = streamed
+        self.inequalityField = inequalityField
+        self.index = index
+        self.estimate = 1.0
+        for f in pushed:
+            self.estimate *= f.selectivity()
+
+    def query(self):
+        """Return the ndb query for the pushed filters, ordered by the
+        inequality property (as the datastore requires), then key for
+        stable cursors."""
+        q = Conference.query()
+        for f in self.pushed:
+            q = q.filter(f.node())
+        if self.inequalityField:
+            q = q.order(Conference._properties[self.inequalityField])
+        return q.order(Conference.key)
+
+    def predicate(self):
+        """Return the streamed filters as one predicate, or None."""
+        if not self.streamed:
+            return None
+        streamed = self.streamed
+        return lambda conf: all(f.matches(conf) for f in streamed)
+
+    def describe(self):
+        return {
+            'pushed': [str(f) for f in self.pushed],
+            'streamed': [str(f) for f in self.streamed],
+            'index': self.index,
+            'order': ([self.inequalityField] if self.inequalityField else []) + ['__key__'],
+            'estimatedSelectivity': round(self.estimate, 6),
+        }
+
+
+def _indexFor(equalities, inequalityField):
+    """Return a description of the index serving these filters, or None if
+    there is none."""
+    if not inequalityField:
+        return 'built-in (merge join)' if len(equalities) > 1 else 'built-in'
+    if not equalities:
+        return 'built-in'
+    fields = tuple(sorted(set(f.field for f in equalities)))
+    # one index entry per filter, so no repeats of a property
+    if len(fields) != len(equalities):
+        return None
+    if (fields, inequalityField) in COMPOSITE_INDEXES:
+        return 'Conference(%s, %s)' % (', '.join(fields), inequalityField)
+    return None
+
+
+def planConferenceQuery(filters):
+    """Return the cheapest feasible Plan for `filters`, and the number of
+    candidate plans considered."""
+    equalities = [f for f in filters if f.isEquality]
+    inequalityFields = sorted(set(f.field for f in filters if not f.isEquality))
+
+    plans = []
+    for inequalityField in [None] + inequalityFields:
+        ranged = [f for f in filters
+                  if not f.isEquality and f.field == inequalityField]
+        for n in range(len(equalities) + 1):
+            for pushedEqualities in itertools.combinations(equalities, n):
+                index = _indexFor(pushedEqualities, inequalityField)
+                if index is None:
+                    continue
+                pushed = list(pushedEqualities) + ranged
+                streamed = [f for f in filters if f not in pushed]
+                plans.append(Plan(pushed, streamed, inequalityField, index))
+    # fewest rows read first, then the least left to do in Python
+    best = min(plans, key=lambda p: (p.estimate, len(p.streamed)))
+    return best, len(plans)
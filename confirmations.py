@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""confirmations.py
+
+Batched confirmation email. Each message is queued on the
+confirmation-email pull queue as a compact JSON task: recipient, template
+name and conference keys. The send_confirmation_emails cron leases up to
+a thousand tasks at a time. It merges them into one email per recipient
+and template, and deletes the tasks once that email is sent.
+
+Every task carries an idempotency key derived from its content. The key
+names the task, so a retried enqueue is refused. The key is also stored
+as an EmailReceipt once its email goes out, so a task that is leased
+again (its delete lost, or its lease expired) is not sent twice.
+
+A failed send leaves its tasks leased, to be retried when the lease
+expires. Groups are only sent while LEASE_MARGIN seconds of the lease are
+left, so a task is never sent after another run could have leased it;
+the rest of the batch is handed back. Tasks are dropped, and logged, after MAX_SEND_ATTEMPTS leases or
+on an error no retry can fix, such as an invalid address.
+
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import EmailReceipt
+
+import cache
+
+QUEUE_NAME = 'confirmation-email'
+LEASE_SECONDS = 120
+LEASE_MARGIN = 30           # lease left, at least, when a group is sent
+LEASE_BATCH = taskqueue.MAX_TASKS_PER_LEASE
+TIME_BUDGET = 60            # seconds of a cron run spent leasing batches
+TEMPLATES = {
+    'conference_created': (
+        'You created a new Conference!',
+        'Hi, you have created the following conference:',
+        'Hi, you have created the following conferences:'),
+}
+MAX_SEND_ATTEMPTS = 5       # leases of a task before it is dropped
+# mail errors a retry cannot fix
+PERMANENT_ERRORS = (mail.InvalidEmailError, mail.InvalidSenderError,
+                    mail.MissingRecipientsError, mail.MissingSubjectError,
+                    mail.MissingBodyError, mail.BadRequestError)
+STATS = ('queued', 'leased', 'sent', 'merged', 'duplicates', 'failed',
+         'dropped', 'released')
+STATS_KEY = 'CONFIRMATION_EMAIL_STATS_%s'
+
+
+def _idempotencyKey(to, template, wscks):
+    return hashlib.sha1('|'.join([template, to] + sorted(wscks))).hexdigest()
+
+
+def confirmationTask(to, c_keys, template='conference_created'):
+    """Return the pull task for a confirmation email to `to` about the
+    Conferences at `c_keys`."""
+    wscks = [c_key.urlsafe() for c_key in c_keys]
+    key = _idempotencyKey(to, template, wscks)
+    return taskqueue.Task(
+        name='confirm-%s' % key, method='PULL',
+        payload=json.dumps({'id': key, 'to': to, 'template': template,
+                            'conferences': wscks}))
+
+
+def queueConfirmation(to, c_keys, template='conference_created'):
+    """Queue a confirmation email; a repeated call is a no-op."""
+    try:
+        taskqueue.Queue(QUEUE_NAME).add(confirmationTask(to, c_keys, template))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        return
+    _countStats({'queued': 1})
+
+
+def _conferenceLine(conf):
+    dates = ' - '.join(str(d) for d in (conf.startDate, conf.endDate) if d)
+    return '  %s (%s)' % (conf.name, ', '.join(
+        part for part in (conf.city, dates) if part))
+
+
+def _render(template, confs):
+    """Return (subject, body) of one email about `confs`."""
+    subject, intro, introMany = TEMPLATES[template]
+    return subject, '%s\r\n\r\n%s' % (
+        introMany if len(confs) > 1 else intro,
+        '\r\n'.join(_conferenceLine(conf) for conf in confs))
+
+
+def _sendBatch(queue, tasks, stats, leaseDeadline):
+    """Send the emails of one leased batch, deleting each group's tasks as
+    soon as its email is sent or given up on. Groups still unsent when the
+    lease nears `leaseDeadline` are released for a later run; returns
+    False if any were."""
+    messages, done = [], []
+    for task in tasks:
+        try:
+            messages.append((task, json.loads(task.payload)))
+        except ValueError:
+            # unreadable; never going to succeed, so drop it
+            done.append(task)
+            stats['failed'] += 1
+
+    receipts = ndb.get_multi([ndb.Key(EmailReceipt, message['id'])
+                              for _, message in messages])
+    groups, seen = {}, set()
+    for (task, message), receipt in zip(messages, receipts):
+        if receipt or message['id'] in seen:
+            done.append(task)
+            stats['duplicates'] += 1
+            continue
+        seen.add(message['id'])
+        groups.setdefault((message['to'], message['template']), []).append(
+            (task, message))
+    if done:
+        queue.delete_tasks(done)
+
+    wscks = sorted(set(wsck for group in groups.values()
+                       for _, message in group for wsck in message['conferences']))
+    confs = dict(zip(wscks, cache.getMulti([ndb.Key(urlsafe=wsck) for wsck in wscks])))
+
+    sender = 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+    groups = groups.items()
+    for i, ((to, template), group) in enumerate(groups):
+        if time.time() > leaseDeadline - LEASE_MARGIN:
+            unsent = [task for _, rest in groups[i:] for task, _ in rest]
+            for task in unsent:
+                queue.modify_task_lease(task, 0)
+            stats['released'] += len(unsent)
+            return False
+        groupTasks = [task for task, _ in group]
+        # conferences whose creation never got written are left out
+        groupConfs = [confs[wsck] for _, message in group
+                      for wsck in message['conferences'] if confs.get(wsck)]
+        if groupConfs:
+            subject, body = _render(template, groupConfs)
+            try:
+                mail.send_mail(sender, to, subject, body)
+            except mail.Error as e:
+                stats['failed'] += len(group)
+                attempts = max(task.retry_count for task in groupTasks) + 1
+                if (isinstance(e, PERMANENT_ERRORS) or
+                        attempts >= MAX_SEND_ATTEMPTS):
+                    logging.error('Dropping %d confirmation email(s) to %s '
+                                  'after %d attempt(s): %r',
+                                  len(group), to, attempts, e)
+                    queue.delete_tasks(groupTasks)
+                    stats['dropped'] += len(group)
+                # otherwise left leased; back when the lease expires
+                continue
+            stats['sent'] += 1
+            stats['merged'] += len(group) - 1
+        # recorded right away, so a later failure in this batch cannot
+        # get this group mailed again
+        ndb.put_multi([EmailReceipt(id=message['id']) for _, message in group])
+        queue.delete_tasks(groupTasks)
+    return True
+
+
+def sendPending(timeBudget=TIME_BUDGET):
+    """Lease and send queued confirmation emails until the queue is empty
+    or the time budget runs out; returns the counts of this run."""
+    queue = taskqueue.Queue(QUEUE_NAME)
+    stats = dict((stat, 0) for stat in STATS)
+    deadline = time.time() + timeBudget
+    try:
+        while time.time() < deadline:
+            leaseDeadline = time.time() + LEASE_SECONDS
+            tasks = queue.lease_tasks(LEASE_SECONDS, LEASE_BATCH)
+            if not tasks:
+                break
+            stats['leased'] += len(tasks)
+            if (not _sendBatch(queue, tasks, stats, leaseDeadline) or
+                    len(tasks) < LEASE_BATCH):
+                break
+    finally:
+        # count what was done even when a batch fails partway
+        _countStats(stats)
+    return stats
+
+
+def _countStats(counts):
+    offsets = dict((STATS_KEY % stat, count) for stat, count in counts.items()
+                   if count)
+    if offsets:
+        memcache.offset_multi(offsets, initial_value=0)
+
+
+def getStats():
+    """Return the queue depth, oldest task age and the running counts."""
+    values = memcache.get_multi([STATS_KEY % stat for stat in STATS])
+    stats = dict((stat, int(values.get(STATS_KEY % stat) or 0)) for stat in STATS)
+    queueStats = taskqueue.Queue(QUEUE_NAME).fetch_statistics()
+    stats['queue_depth'] = queueStats.tasks
+    stats['oldest_eta_usec'] = queueStats.oldest_eta_usec
+    stats['executed_last_minute'] = queueStats.executed_last_minute
+    stats['in_flight'] = queueStats.in_flight
+    return stats
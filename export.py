@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""export.py
+
+Row export of conferences, sessions and registrations as JSON lines or
+CSV. Rows are written straight from a cursor-paged query iterator, never
+as ProtoRPC messages or a full result list. Each request stops after a
+time and size budget and returns the cursor to resume from, so any kind
+can be exported in slices well inside the request deadline.
+
+Registrations are exported from a keys-only query (the key holds both the
+user and the conference). A single indexed field is exported with a
+projection query. Anything else needs full entities, since a multi-
+property projection would need its own composite index.
+
+"""
+
+import csv
+import json
+import time
+
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Conference
+from models import Registration
+from models import Session
+
+FORMATS = ('jsonl', 'csv')
+TIME_BUDGET = 20            # seconds of a request spent writing rows
+BYTE_BUDGET = 16 << 20      # response size per slice
+BATCH_SIZE = 500
+
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+
+def _websafeParentKey(entity):
+    return entity.key.parent().urlsafe()
+
+
+def _value(entity, name):
+    value = getattr(entity, name, None)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+class _Export(object):
+    """An exportable kind: its model, columns and, for key derived
+    columns, how to compute them."""
+
+    def __init__(self, model, columns, derived=None, keysOnly=False):
+        self.model = model
+        self.columns = columns
+        self.derived = derived or {}
+        self.keysOnly = keysOnly
+
+    def projectable(self, name):
+        """Return True if `name` can be read with a projection query."""
+        prop = self.model._properties.get(name)
+        return bool(prop and prop._indexed and not prop._repeated)
+
+    def row(self, entity, columns):
+        return [self.derived[name](entity) if name in self.derived
+                else _value(entity, name) for name in columns]
+
+
+EXPORTS = {
+    'conferences': _Export(Conference, [
+        'websafeKey', 'name', 'description', 'organizerUserId',
+        'organizerDisplayName', 'topics', 'city', 'startDate', 'endDate',
+        'month', 'maxAttendees', 'seatsAvailable'],
+        derived={'websafeKey': _websafeKey}),
+    'sessions': _Export(Session, [
+        'websafeKey', 'websafeConferenceKey', 'name', 'description',
+        'highlights', 'speaker', 'typeOfSession', 'sessionDate', 'startTime',
+        'duration'],
+        derived={'websafeKey': _websafeKey,
+                 'websafeConferenceKey': _websafeParentKey}),
+    'registrations': _Export(Registration, [
+        'userId', 'websafeConferenceKey'],
+        # Registration keys are Profile(userId)/Registration(wsck)
+        derived={'userId': lambda key: key.parent().id(),
+                 'websafeConferenceKey': lambda key: key.id()},
+        keysOnly=True),
+}
+
+
+def columnsFor(kind, fields=None):
+    """Return the columns to export for `kind`: `fields` (validated) or all."""
+    export = EXPORTS[kind]
+    if not fields:
+        return list(export.columns)
+    unknown = [name for name in fields if name not in export.columns]
+    if unknown:
+        raise ValueError('Unknown %s fields: %s' % (kind, ', '.join(unknown)))
+    return list(fields)
+
+
+def _queryOptions(export, columns, ancestor, filters):
+    """Return the iter() options: keys only, a single property projection
+    (not with an ancestor or filters, which would need a composite index)
+    or full entities."""
+    if export.keysOnly:
+        return {'keys_only': True}
+    stored = [name for name in columns if name not in export.derived]
+    if (len(stored) == 1 and export.projectable(stored[0])
+            and ancestor is None and not filters):
+        return {'projection': [export.model._properties[stored[0]]]}
+    return {}
+
+
+def _csvValue(value):
+    """Return a CSV cell: utf-8 bytes, lists joined with '|'."""
+    if isinstance(value, list):
+        value = u'|'.join(unicode(v) for v in value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return '' if value is None else value
+
+
+class _Writer(object):
+    """Writes rows to a file object as JSON lines or CSV, counting bytes."""
+
+    def __init__(self, out, fmt, columns, header):
+        self.out = out
+        self.columns = columns
+        self.bytes = 0
+        self.csv = csv.writer(self) if fmt == 'csv' else None
+        if self.csv and header:
+            self.csv.writerow(columns)
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.out.write(data)
+
+    def row(self, values):
+        if self.csv:
+            self.csv.writerow([_csvValue(value) for value in values])
+        else:
+            self.write(json.dumps(dict(zip(self.columns, values))) + '\n')
+
+
+def exportRows(out, kind, fmt, columns, cursor=None, ancestor=None,
+               filters=(), timeBudget=TIME_BUDGET, byteBudget=BYTE_BUDGET):
+    """Write rows of `kind` to `out` from `cursor` on until the budgets run
+    out; returns (rows written, cursor to resume from or None when done)."""
+    export = EXPORTS[kind]
+    options = _queryOptions(export, columns, ancestor, filters)
+    query = export.model.query(ancestor=ancestor)
+    for f in filters:
+        query = query.filter(f)
+    # a fixed order keeps the resume cursor valid between slices; a
+    # projection is read in its property's (built-in) index order
+    for prop in options.get('projection', []):
+        query = query.order(prop)
+    query = query.order(export.model.key)
+
+    # resumed slices continue the same CSV, so only the first has a header
+    writer = _Writer(out, fmt, columns, header=not cursor)
+    deadline = time.time() + timeBudget
+    start = Cursor(urlsafe=cursor) if cursor else None
+    it = query.iter(start_cursor=start, produce_cursors=True,
+                    batch_size=BATCH_SIZE, **options)
+    rows = 0
+    for entity in it:
+        writer.row(export.row(entity, columns))
+        rows += 1
+        if time.time() > deadline or writer.bytes > byteBudget:
+            if it.probably_has_next():
+                return rows, it.cursor_after().urlsafe()
+            break
+    return rows, None
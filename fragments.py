@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""fragments.py
+
+Cache of serialized form messages for list responses. Each entity's form
+is kept under its key and version (see versions.touch), so a write makes
+the old fragment unreachable instead of having to invalidate it.
+
+Fragments are looked up in an in-process LRU first and then in memcache,
+where they are stored protobuf-encoded. Only the misses are copied from
+their entities, with one batched call. Forms handed out by the in-process
+cache are shared between requests and must not be modified.
+
+"""
+
+import collections
+import threading
+
+from google.appengine.api import memcache
+from protorpc import protobuf
+
+FRAGMENT_VERSION = 1
+FRAGMENT_TTL = 60 * 60
+LOCAL_FRAGMENTS = 5000      # forms kept per instance
+STATS = ('local_hits', 'memcache_hits', 'misses')
+STATS_KEY_TPL = 'FRAGMENT_CACHE_v%d_STATS_%s'
+
+_local = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def _cacheKey(entity, message_cls):
+    return 'FRAGMENT_v%d_%s_%s_%d' % (FRAGMENT_VERSION, message_cls.__name__,
+                                     entity.key.urlsafe(), entity.version or 0)
+
+
+def _getLocal(cache_keys):
+    found = {}
+    with _lock:
+        for cache_key in cache_keys:
+            form = _local.pop(cache_key, None)
+            if form is not None:
+                # re-insert as the most recently used
+                _local[cache_key] = form
+                found[cache_key] = form
+    return found
+
+
+def _setLocal(forms):
+    with _lock:
+        for cache_key, form in forms.items():
+            _local.pop(cache_key, None)
+            _local[cache_key] = form
+        while len(_local) > LOCAL_FRAGMENTS:
+            _local.popitem(last=False)
+
+
+def serializeMulti(entities, message_cls, build, cacheable=None):
+    """Return a `message_cls` form per entity, from the fragment cache
+    where possible. `build` copies a list of entities to forms and is
+    called once with the misses. Entities for which `cacheable` returns
+    False (e.g. forms that need more than the entity) are always built.
+    """
+    entities = list(entities)
+    cache_keys = [_cacheKey(entity, message_cls)
+                  if cacheable is None or cacheable(entity) else None
+                  for entity in entities]
+    wanted = [cache_key for cache_key in cache_keys if cache_key]
+    found = _getLocal(wanted)
+    localHits = len(found)
+
+    remote = [cache_key for cache_key in wanted if cache_key not in found]
+    decoded = {}
+    if remote:
+        for cache_key, data in memcache.get_multi(remote).items():
+            decoded[cache_key] = protobuf.decode_message(message_cls, data)
+        _setLocal(decoded)
+        found.update(decoded)
+
+    missing = [i for i, cache_key in enumerate(cache_keys)
+               if cache_key not in found]
+    built = build([entities[i] for i in missing]) if missing else []
+    forms = [found.get(cache_key) for cache_key in cache_keys]
+    fills = {}
+    for i, form in zip(missing, built):
+        forms[i] = form
+        if cache_keys[i]:
+            fills[cache_keys[i]] = form
+    if fills:
+        _setLocal(fills)
+        memcache.Client().set_multi_async(
+            dict((cache_key, protobuf.encode_message(form))
+                 for cache_key, form in fills.items()), time=FRAGMENT_TTL)
+
+    _countStats(localHits, len(decoded), len(missing))
+    return forms
+
+
+def _countStats(localHits, memcacheHits, misses):
+    offsets = dict((STATS_KEY_TPL % (FRAGMENT_VERSION, stat), count)
+                   for stat, count in zip(STATS, (localHits, memcacheHits, misses))
+                   if count)
+    if offsets:
+        memcache.Client().offset_multi_async(offsets, initial_value=0)
+
+
+def getStats():
+    """Return {'local_hits', 'memcache_hits', 'misses'} counts."""
+    values = memcache.get_multi([STATS_KEY_TPL % (FRAGMENT_VERSION, stat)
+                                 for stat in STATS])
+    return dict((stat, int(values.get(STATS_KEY_TPL % (FRAGMENT_VERSION, stat)) or 0))
+                for stat in STATS)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Per-endpoint instrumentation for ConferenceApi methods and the main.app
+handlers. For each call it records wall and CPU time, datastore RPCs by
+type, memcache hits and misses, taskqueue adds and response size. These
+are added to memcache counters in fixed time windows, which the admin
+stats handler sums into rolling histograms. A sampled share of calls also
+keeps a per-RPC trace.
+
+API calls are observed with apiproxy pre/post call hooks, the same way
+appstats does it. Response sizes are counted from the body the WSGI layer
+passes on; an API method's call is recorded once the endpoints server
+(wrapped with measureResponses) has produced its response. Instrumentation
+is off by default. With settings.INSTRUMENTATION_ENABLED off, the
+decorator and the WSGI wrappers return what they are given and no hooks
+are installed, so there is no overhead.
+
+"""
+
+import functools
+import random
+import re
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import quota
+
+from settings import INSTRUMENTATION_ENABLED
+from settings import TRACE_SAMPLE_RATE
+
+WINDOW_SECONDS = 300
+WINDOWS = 12                    # rolling stats cover the last hour
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DATASTORE_CALLS = ('Get', 'Put', 'Delete', 'RunQuery', 'Next', 'AllocateIds',
+                   'BeginTransaction', 'Commit', 'Rollback')
+COUNTERS = ('calls', 'errors', 'wall_ms', 'cpu_ms', 'datastore_rpcs',
+            'memcache_hits', 'memcache_misses', 'taskqueue_adds',
+            'response_bytes')
+TRACE_SLOTS = 10                # traces kept per endpoint
+KEY_TPL = 'INSTRUMENTATION_%d_%s_%s'
+TRACE_KEY_TPL = 'INSTRUMENTATION_TRACE_%s_%d'
+
+_local = threading.local()
+_names = set()
+_hooksInstalled = []
+
+
+# - - - recording - - - - - - - - - - - - - - - - - - - -
+
+class _Record(object):
+    """What one call did, filled by the apiproxy hooks."""
+
+    def __init__(self, trace):
+        self.start = time.time()
+        self.cpuStart = quota.get_request_cpu_usage()
+        self.counts = dict((name, 0) for name in COUNTERS)
+        self.datastore = {}
+        self.trace = [] if trace else None
+        self.pending = {}           # id(rpc) -> start time, for traces
+
+
+def _preCall(service, call, request, response, rpc):
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    if service == 'datastore_v3':
+        record.counts['datastore_rpcs'] += 1
+        call = call if call in DATASTORE_CALLS else 'Other'
+        record.datastore[call] = record.datastore.get(call, 0) + 1
+    elif service == 'taskqueue':
+        if call == 'BulkAdd':
+            record.counts['taskqueue_adds'] += request.add_request_size()
+        elif call == 'Add':
+            record.counts['taskqueue_adds'] += 1
+    if record.trace is not None:
+        record.pending[id(rpc)] = time.time()
+
+
+def _postCall(service, call, request, response, rpc):
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    if service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        record.counts['memcache_hits'] += hits
+        record.counts['memcache_misses'] += request.key_size() - hits
+    if record.trace is not None:
+        started = record.pending.pop(id(rpc), None)
+        if started is not None:
+            record.trace.append(('%s.%s' % (service, call),
+                                 int((started - record.start) * 1000),
+                                 int((time.time() - started) * 1000)))
+
+
+def _installHooks():
+    if not _hooksInstalled:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'instrumentation', _preCall)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'instrumentation', _postCall)
+        _hooksInstalled.append(True)
+
+
+def _begin():
+    """Start recording the current call; returns None if one already is."""
+    if getattr(_local, 'record', None) is not None:
+        return None
+    record = _local.record = _Record(random.random() < TRACE_SAMPLE_RATE)
+    return record
+
+
+def _stop(record, error):
+    """Stop recording the current call."""
+    _local.record = None
+    counts = record.counts
+    counts['calls'] = 1
+    counts['errors'] = int(error)
+    counts['wall_ms'] = int((time.time() - record.start) * 1000)
+    counts['cpu_ms'] = int(1000 * quota.megacycles_to_cpu_seconds(
+        quota.get_request_cpu_usage() - record.cpuStart))
+
+
+def _end(name, record, responseBytes):
+    """Add a stopped call to the current window's counters."""
+    counts = record.counts
+    wall = counts['wall_ms']
+    counts['response_bytes'] = responseBytes
+    for call, count in record.datastore.items():
+        counts['datastore_' + call] = count
+    counts['latency_' + _bucket(wall)] = 1
+
+    window = int(time.time()) // WINDOW_SECONDS
+    offsets = dict((KEY_TPL % (window, name, counter), value)
+                   for counter, value in counts.items() if value)
+    client = memcache.Client()
+    # old windows are never read again and age out of memcache
+    client.offset_multi_async(offsets, initial_value=0)
+    if record.trace is not None:
+        client.set_multi_async({TRACE_KEY_TPL % (name, random.randrange(TRACE_SLOTS)): {
+            'at': record.start, 'wall_ms': wall, 'error': bool(counts['errors']),
+            'rpcs': record.trace}}, time=WINDOW_SECONDS * WINDOWS)
+
+
+def _bucket(ms):
+    """Return the histogram bucket label for a latency."""
+    for bound in LATENCY_BUCKETS_MS:
+        if ms <= bound:
+            return str(bound)
+    return 'inf'
+
+
+def instrumented(method):
+    """Record every call of an API method (under its name)."""
+    if not INSTRUMENTATION_ENABLED:
+        return method
+    _installHooks()
+    name = method.__name__
+    _names.add(name)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        record = _begin()
+        if record is None:
+            return method(*args, **kwargs)
+        error = True
+        try:
+            result = method(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            _stop(record, error)
+            responses = getattr(_local, 'responses', None)
+            if responses is not None:
+                # sized by measureResponses once the response is encoded
+                responses.append((name, record))
+            else:
+                _end(name, record, 0)
+
+    return wrapper
+
+
+def _readBody(app, environ, start_response):
+    """Run `app`, returning (body chunks, status line or None, size)."""
+    status = []
+
+    def recordingStartResponse(status_line, headers, exc_info=None):
+        status.append(status_line)
+        return start_response(status_line, headers, exc_info)
+
+    body, size = [], 0
+    for chunk in app(environ, recordingStartResponse):
+        size += len(chunk)
+        body.append(chunk)
+    return body, (status[0] if status else None), size
+
+
+def measureResponses(app):
+    """Return the endpoints API server `app` recording the response size
+    of the instrumented methods it calls."""
+    if not INSTRUMENTATION_ENABLED:
+        return app
+
+    def wrapper(environ, start_response):
+        _local.responses = []
+        size = 0
+        try:
+            body, _, size = _readBody(app, environ, start_response)
+            return body
+        finally:
+            responses, _local.responses = _local.responses, None
+            for name, record in responses:
+                _end(name, record, size)
+
+    return wrapper
+
+
+def instrumentWsgi(app, paths):
+    """Return `app` recording every request, under the first of `paths`
+    (the app's route patterns) it matches and 'other' otherwise."""
+    if not INSTRUMENTATION_ENABLED:
+        return app
+    _installHooks()
+    patterns = [(path, re.compile('^%s$' % path)) for path in paths]
+    _names.update(paths)
+    _names.add('other')
+
+    def wrapper(environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        name = next((p for p, pattern in patterns if pattern.match(path)),
+                    'other')
+        record = _begin()
+        size, error = 0, True
+        try:
+            body, status, size = _readBody(app, environ, start_response)
+            error = not status or status[:1] == '5'
+            return body
+        finally:
+            if record is not None:
+                _stop(record, error)
+                _end(name, record, size)
+
+    return wrapper
+
+
+# - - - reporting - - - - - - - - - - - - - - - - - - - -
+
+def _percentile(histogram, calls, p):
+    """Estimate a percentile as the upper bound of its histogram bucket."""
+    rank, seen = p / 100.0 * calls, 0
+    for label in [str(b) for b in LATENCY_BUCKETS_MS] + ['inf']:
+        seen += histogram.get(label, 0)
+        if seen >= rank:
+            return label
+    return 'inf'
+
+
+def getStats(names=None, traces=False):
+    """Return {name: stats} summed over the last WINDOWS windows, with
+    latency histograms, estimated percentiles and per call averages."""
+    names = sorted(names or _names)
+    counters = (list(COUNTERS) +
+                ['datastore_' + call for call in DATASTORE_CALLS + ('Other',)] +
+                ['latency_' + str(b) for b in LATENCY_BUCKETS_MS] + ['latency_inf'])
+    now = int(time.time()) // WINDOW_SECONDS
+    keys = [(name, counter, KEY_TPL % (window, name, counter))
+            for name in names for counter in counters
+            for window in range(now - WINDOWS + 1, now + 1)]
+    values = memcache.get_multi([key for _, _, key in keys])
+
+    totals = dict((name, {}) for name in names)
+    for name, counter, key in keys:
+        if values.get(key):
+            totals[name][counter] = totals[name].get(counter, 0) + int(values[key])
+
+    stats = {}
+    for name, total in totals.items():
+        calls = total.get('calls', 0)
+        if not calls:
+            continue
+        histogram = dict((counter[len('latency_'):], count)
+                         for counter, count in total.items()
+                         if counter.startswith('latency_'))
+        entry = {
+            'calls': calls,
+            'errors': total.get('errors', 0),
+            'latency_histogram_ms': histogram,
+            'p50_ms': _percentile(histogram, calls, 50),
+            'p95_ms': _percentile(histogram, calls, 95),
+            'p99_ms': _percentile(histogram, calls, 99),
+            'datastore_rpcs_by_type': dict(
+                (counter[len('datastore_'):], count)
+                for counter, count in total.items()
+                if counter.startswith('datastore_') and counter != 'datastore_rpcs'),
+        }
+        for counter in COUNTERS:
+            if counter not in ('calls', 'errors'):
+                entry['mean_' + counter] = round(total.get(counter, 0) / float(calls), 2)
+        lookups = total.get('memcache_hits', 0) + total.get('memcache_misses', 0)
+        entry['memcache_hit_rate'] = (round(total.get('memcache_hits', 0) /
+                                            float(lookups), 3) if lookups else None)
+        stats[name] = entry
+
+    if traces:
+        traceKeys = [TRACE_KEY_TPL % (name, slot)
+                     for name in names for slot in range(TRACE_SLOTS)]
+        found = memcache.get_multi(traceKeys)
+        for name in names:
+            sampled = [found[TRACE_KEY_TPL % (name, slot)]
+                       for slot in range(TRACE_SLOTS)
+                       if TRACE_KEY_TPL % (name, slot) in found]
+            if sampled and name in stats:
+                stats[name]['traces'] = sorted(sampled, key=lambda t: -t['at'])
+    return stats
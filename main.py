@@ -12,10 +12,29 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
 from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
 from google.appengine.api import mail
+from google.appengine.api import users
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from models import Profile
+from models import Registration
+from utils import getTokenCacheStats
+from utils import getUserId
+import cache
+import confirmations
+import export
+import fragments
+import instrumentation
+import seats
+import speakers
+import textindex
+import unitofwork
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -24,9 +43,17 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send the queued confirmation emails, merged per recipient."""
+        confirmations.sendPending()
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation; only drains push
+        tasks queued before confirmations moved to the pull queue."""
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -38,15 +65,175 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a Conference's summed seat shards onto its seatsAvailable."""
+        seats.syncSeatsAvailable(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+
+
+class MigrateProfilesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move one page of legacy Profile registrations and wishlists to
+        Registration and WishlistEntry entities, queueing the next page."""
+        ConferenceApi._migrateProfilesBatch(self.request.get('cursor'))
+        self.response.set_status(204)
+
+    def get(self):
+        """Start the Profile migration from the first Profile."""
+        ConferenceApi._migrateProfilesBatch()
+        self.response.set_status(204)
+
+
+class IndexSpeakersHandler(webapp2.RequestHandler):
+    def post(self):
+        """Add one page of existing Sessions to the speaker index, queueing
+        the next page."""
+        speakers.indexSpeakersBatch(self.request.get('cursor'))
+        self.response.set_status(204)
+
+    def get(self):
+        """Start indexing existing Sessions from the first one."""
+        speakers.indexSpeakersBatch()
+        self.response.set_status(204)
+
+
+class IndexTextHandler(webapp2.RequestHandler):
+    def post(self):
+        """Reindex the Conferences and Sessions at the given keys, or one
+        page of a backfill of a kind, queueing the next page."""
+        kind = self.request.get('kind')
+        if kind:
+            textindex.indexAllBatch(kind, self.request.get('cursor'))
+        else:
+            textindex.indexEntities([ndb.Key(urlsafe=key)
+                                     for key in self.request.get_all('key')])
+        self.response.set_status(204)
+
+    def get(self):
+        """Start indexing all existing Conferences and Sessions."""
+        for kind in ('Conference', 'Session'):
+            textindex.indexAllBatch(kind)
+        self.response.set_status(204)
+
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organizer's new displayName onto one page of their
+        Conferences, queueing the next page."""
+        ConferenceApi._updateOrganizerNameBatch(self.request.get('userId'),
+                                                self.request.get('cursor'))
+        self.response.set_status(204)
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report entity cache hits and misses per kind, the OAuth token
+        and form fragment cache counters and the unit of work savings per
+        endpoint as JSON."""
+        stats = cache.getStats()
+        stats['OAuthToken'] = getTokenCacheStats()
+        stats['Fragments'] = fragments.getStats()
+        stats['UnitOfWork'] = unitofwork.getStats()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
 class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
-        """Background job to select appropriate keynote speaker, triggered upon createSession"""
-        ConferenceApi._calculateFeaturedSpeaker(self.request.get('websafeConferenceKey'),
-                                                self.request.get('websafeSessionKey'))
+        """Background job to select appropriate keynote speaker, triggered
+        (at most once per conference per few seconds) by new sessions"""
+        ConferenceApi._calculateFeaturedSpeaker(self.request.get('websafeConferenceKey'))
         
 
-app = webapp2.WSGIApplication([
+class ExportHandler(webapp2.RequestHandler):
+    def get(self, kind):
+        """Export conferences, sessions or registrations as JSON lines
+        (format=jsonl) or CSV (format=csv), optionally only some fields=
+        (comma separated). Each response is one time-boxed slice; pass its
+        X-Export-Cursor header back as cursor= for the next. Admins may
+        export everything, organizers their own conferences and, given a
+        websafeConferenceKey, one conference's sessions or registrations."""
+        user = users.get_current_user()
+        if not user:
+            self.abort(401)
+        fmt = self.request.get('format', 'jsonl')
+        if fmt not in export.FORMATS:
+            self.abort(400, detail='format must be one of %s' % ', '.join(export.FORMATS))
+        try:
+            columns = export.columnsFor(
+                kind, [f for f in self.request.get('fields').split(',') if f])
+            wsck = self.request.get('websafeConferenceKey')
+            c_key = ndb.Key(urlsafe=wsck) if wsck else None
+        except (ValueError, TypeError, ProtocolBufferDecodeError) as e:
+            self.abort(400, detail=str(e))
+
+        # organizers are limited to their own Profile's entity group
+        p_key = None
+        if not users.is_current_user_admin():
+            p_key = ndb.Key(Profile, getUserId(user))
+            if c_key and c_key.parent() != p_key:
+                self.abort(403)
+
+        ancestor, filters = None, ()
+        if kind == 'conferences':
+            ancestor = p_key
+        elif kind == 'sessions':
+            ancestor = c_key or p_key
+        elif c_key:
+            filters = (Registration.conferenceKey == c_key,)
+        elif p_key:
+            self.abort(400, detail='websafeConferenceKey required')
+
+        self.response.headers['Content-Type'] = (
+            'text/csv' if fmt == 'csv' else 'application/x-ndjson')
+        try:
+            rows, cursor = export.exportRows(
+                self.response.out, kind, fmt, columns,
+                cursor=self.request.get('cursor') or None,
+                ancestor=ancestor, filters=filters)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            self.abort(400, detail='Invalid cursor')
+        self.response.headers['X-Export-Rows'] = str(rows)
+        if cursor:
+            self.response.headers['X-Export-Cursor'] = cursor
+
+
+class EmailStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report the confirmation email queue depth and send counts as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(confirmations.getStats()))
+
+
+class InstrumentationHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report rolling per-endpoint latency and RPC stats as JSON; add
+        traces=1 for the sampled traces and name= to pick endpoints."""
+        stats = instrumentation.getStats(
+            names=self.request.get_all('name'),
+            traces=bool(self.request.get('traces')))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+routes = [
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
-], debug=True)
\ No newline at end of file
+    ('/tasks/sync_seats_available', SyncSeatsAvailableHandler),
+    ('/tasks/migrate_profiles', MigrateProfilesHandler),
+    # old name, for tasks queued before the wishlist migration joined it
+    ('/tasks/migrate_registrations', MigrateProfilesHandler),
+    ('/tasks/index_speakers', IndexSpeakersHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/index_text', IndexTextHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/instrumentation', InstrumentationHandler),
+    ('/admin/email_stats', EmailStatsHandler),
+    ('/export/(conferences|sessions|registrations)', ExportHandler),
+]
+app = instrumentation.instrumentWsgi(
+    webapp2.WSGIApplication(routes, debug=True),
+    [path for path, _ in routes])
\ No newline at end of file
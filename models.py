@@ -28,8 +28,21 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    sessionKeysWishlist = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True)  # legacy, see Registration
+    sessionKeysWishlist = ndb.StringProperty(repeated=True)  # legacy, see WishlistEntry
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class Registration(ndb.Model):
+    """Registration -- a Profile's registration for a Conference; child of
+    the Profile, keyed by the websafe Conference key"""
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+
+
+class WishlistEntry(ndb.Model):
+    """WishlistEntry -- a Session on a Profile's wishlist; child of the
+    Profile, keyed by the websafe Session key"""
+    sessionKey = ndb.KeyProperty(kind='Session')
 
 
 class ProfileMiniForm(messages.Message):
@@ -45,6 +58,13 @@ class ProfileForm(messages.Message):
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
     sessionKeysWishlist = messages.StringField(5, repeated=True)
+    etag = messages.StringField(6)
+    notModified = messages.BooleanField(7)  # etag matched, nothing else set
+
+
+class WishlistForm(messages.Message):
+    """WishlistForm -- multiple Session keys inbound form message"""
+    websafeSessionKeys = messages.StringField(1, repeated=True)
 
 
 class StringMessage(messages.Message):
@@ -62,13 +82,22 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False)  # copy of the Profile's
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
     month           = ndb.IntegerProperty()  # TODO: do we need for indexing like Java?
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
-    seatsAvailable  = ndb.IntegerProperty()
+    seatsAvailable  = ndb.IntegerProperty()  # synced from the SeatShards
+    seatShards      = ndb.IntegerProperty(default=0)  # 0 until sharded
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats"""
+    conference      = ndb.KeyProperty(kind='Conference')
+    count           = ndb.IntegerProperty(default=0, indexed=False)
 
 
 class Session(ndb.Model):
@@ -81,6 +110,41 @@ class Session(ndb.Model):
     typeOfSession           = ndb.StringProperty(default='NOT_SPECIFIED')
     duration                = ndb.IntegerProperty()
     speaker                 = ndb.StringProperty(required=True)
+    version                 = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class SpeakerSession(ndb.Model):
+    """SpeakerSession -- one Session of a speaker in the speaker index,
+    keyed by normalized speaker name and websafe Session key"""
+    speaker                 = ndb.StringProperty()  # normalized name
+    sessionKey              = ndb.KeyProperty(kind='Session', indexed=False)
+
+
+class SpeakerTally(ndb.Model):
+    """SpeakerTally -- per-Conference speaker -> session names aggregate,
+    used to pick the featured speaker; single child of the Conference"""
+    sessionNames            = ndb.JsonProperty()  # {speaker: [session name]}
+    featuredSpeaker         = ndb.StringProperty(indexed=False)
+
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- singleton set of the conferences named in the
+    announcement, kept up to date as their seatsAvailable changes"""
+    conferenceNames         = ndb.JsonProperty()  # {websafeConferenceKey: name}
+
+
+class EmailReceipt(ndb.Model):
+    """EmailReceipt -- marks a queued email as sent, keyed by the email's
+    idempotency key"""
+    sent                    = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class Posting(ndb.Model):
+    """Posting -- one term of one Conference or Session in the full-text
+    index, keyed by term under a PostingDoc root per document"""
+    term                    = ndb.StringProperty()  # 'Kind:term'
+    doc                     = ndb.KeyProperty()
+    weight                  = ndb.IntegerProperty()
 
 
 class ConferenceForm(messages.Message):
@@ -97,6 +161,8 @@ class ConferenceForm(messages.Message):
     endDate                 = messages.StringField(10)  # DateTimeField()
     websafeKey              = messages.StringField(11)
     organizerDisplayName    = messages.StringField(12)
+    etag                    = messages.StringField(13)
+    notModified             = messages.BooleanField(14)  # etag matched, nothing else set
 
 
 class SessionForm(messages.Message):
@@ -115,11 +181,42 @@ class SessionForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    queryPlan = messages.StringField(3)  # JSON, queryConferences explain only
+    etag = messages.StringField(4)
+    notModified = messages.BooleanField(5)  # etag matched, nothing else set
 
 
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    etag = messages.StringField(3)
+    notModified = messages.BooleanField(4)  # etag matched, nothing else set
+
+
+class ConferenceImportForm(messages.Message):
+    """ConferenceImportForm -- a new Conference (conference) or an existing
+    one (websafeConferenceKey) with Sessions to add, bulk import message"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    websafeConferenceKey = messages.StringField(2)
+    sessions = messages.MessageField(SessionForm, 3, repeated=True)
+
+
+class BulkImportForm(messages.Message):
+    """BulkImportForm -- bulk import inbound form message"""
+    conferences = messages.MessageField(ConferenceImportForm, 1, repeated=True)
+
+
+class BulkImportResultForm(messages.Message):
+    """BulkImportResultForm -- keys of one imported Conference & its new Sessions"""
+    websafeConferenceKey = messages.StringField(1)
+    websafeSessionKeys = messages.StringField(2, repeated=True)
+
+
+class BulkImportResultForms(messages.Message):
+    """BulkImportResultForms -- bulk import outbound form message"""
+    items = messages.MessageField(BulkImportResultForm, 1, repeated=True)
 
 
 class TeeShirtSize(messages.Enum):
@@ -159,4 +256,20 @@ class ConferenceQueryForm(messages.Message):
 
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
-    filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
\ No newline at end of file
+    filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    explain = messages.BooleanField(4)  # return the query plan, not results
+
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session advanced query inbound form message"""
+    typeOfSession = messages.EnumField('TypeOfSession', 1, repeated=True)
+    excludeTypeOfSession = messages.EnumField('TypeOfSession', 2, repeated=True)
+    startTimeFrom = messages.StringField(3)     # HH:MM, inclusive
+    startTimeBefore = messages.StringField(4)   # HH:MM, exclusive
+    sessionDateFrom = messages.StringField(5)   # YYYY-MM-DD, inclusive
+    sessionDateTo = messages.StringField(6)     # YYYY-MM-DD, inclusive
+    websafeConferenceKey = messages.StringField(7)
+    pageSize = messages.IntegerField(8)
+    pageToken = messages.StringField(9)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counters for Conference registration. Each Conference's
+available seats are split over SeatShard root entities so concurrent
+registrations write to different entity groups instead of all contending
+on the Conference itself.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+import announcements
+import cache
+import versions
+
+# an xg transaction may span at most 25 entity groups; registration also
+# touches the Profile and the Conference, so leave room for those
+MAX_SEAT_SHARDS = 20
+SEATS_PER_SHARD = 10
+SEAT_SYNC_DELAY = 5     # seconds between Conference.seatsAvailable syncs
+
+
+def seatShardCount(seats):
+    """Return the number of shards to use for a conference with `seats`."""
+    return max(1, min(MAX_SEAT_SHARDS, (seats or 0) // SEATS_PER_SHARD))
+
+
+def seatShardKeys(conf_key, count):
+    """Return the keys of the `count` seat shards of a conference."""
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (wsck, i)) for i in range(count)]
+
+
+def buildSeatShards(conf_key, seats, count):
+    """Return `count` SeatShard entities sharing `seats` as evenly as possible."""
+    base, extra = divmod(max(seats or 0, 0), count)
+    return [SeatShard(key=key, conference=conf_key,
+                      count=base + (1 if i < extra else 0))
+            for i, key in enumerate(seatShardKeys(conf_key, count))]
+
+
+def getSeatsAvailable(conf):
+    """Return the summed seats available across a conference's shards."""
+    if not conf.seatShards:
+        # not sharded yet, the Conference entity is still authoritative
+        return conf.seatsAvailable
+    shards = ndb.get_multi(seatShardKeys(conf.key, conf.seatShards))
+    return sum(shard.count for shard in shards if shard)
+
+
+def getSeatsAvailableMulti(confs):
+    """Return {conference key: seats available} with a single get_multi."""
+    keys = []
+    for conf in confs:
+        keys.extend(seatShardKeys(conf.key, conf.seatShards))
+    seats = dict((conf.key, conf.seatsAvailable) for conf in confs
+                 if not conf.seatShards)
+    for shard in ndb.get_multi(keys):
+        if shard:
+            seats[shard.conference] = seats.get(shard.conference, 0) + shard.count
+    return seats
+
+
+@ndb.transactional(xg=True)
+def ensureSeatShards(conf_key):
+    """Split a not yet sharded Conference's seatsAvailable over new shards.
+
+    Runs in the same transaction as the caller when there is one, so two
+    first registrations cannot both create shards for the same conference.
+    """
+    conf = conf_key.get()
+    if not conf.seatShards:
+        conf.seatShards = seatShardCount(conf.maxAttendees)
+        ndb.put_multi([conf] + buildSeatShards(
+            conf.key, conf.seatsAvailable, conf.seatShards))
+        cache.invalidate(conf.key)
+    return conf
+
+
+def takeSeat(conf):
+    """Take one seat from a random shard of the conference.
+
+    Must be called inside a transaction. When the chosen shard has run dry
+    the remaining seats are rebalanced over all shards before taking one.
+    Returns False if the conference is sold out.
+    """
+    keys = seatShardKeys(conf.key, conf.seatShards)
+    shard = random.choice(keys).get()
+    if shard and shard.count > 0:
+        shard.count -= 1
+        shard.put()
+    elif not _rebalanceSeats(conf, keys, -1):
+        return False
+    _onCommitSyncSeats(conf.key)
+    return True
+
+
+def returnSeat(conf):
+    """Give one seat back to a random shard; must run inside a transaction."""
+    key = random.choice(seatShardKeys(conf.key, conf.seatShards))
+    shard = key.get() or SeatShard(key=key, conference=conf.key, count=0)
+    shard.count += 1
+    shard.put()
+    _onCommitSyncSeats(conf.key)
+
+
+def resetSeats(conf, seats):
+    """Replace a conference's shards with `seats` spread over a fresh set.
+
+    Must be called inside an xg transaction that has already loaded `conf`.
+    """
+    old_count = conf.seatShards
+    conf.seatShards = seatShardCount(conf.maxAttendees)
+    conf.seatsAvailable = seats
+    ndb.put_multi(buildSeatShards(conf.key, seats, conf.seatShards))
+    if old_count > conf.seatShards:
+        ndb.delete_multi(seatShardKeys(conf.key, old_count)[conf.seatShards:])
+
+
+def _rebalanceSeats(conf, keys, delta):
+    """Spread the conference's seats (plus `delta`) evenly over all shards.
+
+    Returns False, leaving the shards untouched, if that would oversell.
+    """
+    shards = ndb.get_multi(keys)
+    total = sum(shard.count for shard in shards if shard) + delta
+    if total < 0:
+        return False
+    ndb.put_multi(buildSeatShards(conf.key, total, len(keys)))
+    return True
+
+
+def _onCommitSyncSeats(conf_key):
+    """Schedule a Conference.seatsAvailable sync and advance the
+    Conference's generation (its seat count changed) once the transaction
+    commits."""
+    ndb.get_context().call_on_commit(lambda: scheduleSeatSync(conf_key))
+    versions.bump(versions.conference(conf_key))
+
+
+def scheduleSeatSync(conf_key):
+    """Queue one sync task per conference per SEAT_SYNC_DELAY window, so a
+    burst of registrations costs a single write to the Conference entity.
+    """
+    wsck = conf_key.urlsafe()
+    try:
+        taskqueue.add(
+            name='seats-%s-%d' % (wsck, int(time.time()) // SEAT_SYNC_DELAY),
+            params={'websafeConferenceKey': wsck},
+            url='/tasks/sync_seats_available',
+            countdown=SEAT_SYNC_DELAY,
+        )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # a sync is already scheduled for this window
+        pass
+
+
+def syncSeatsAvailable(conf_key):
+    """Copy the summed shard value onto Conference.seatsAvailable, which is
+    what datastore queries (e.g. the announcement) filter on.
+    """
+    conf = conf_key.get()
+    if conf and conf.seatShards:
+        _setSeatsAvailable(conf_key, getSeatsAvailable(conf))
+
+
+@ndb.transactional()
+def _setSeatsAvailable(conf_key, seats):
+    """Write `seats` to Conference.seatsAvailable."""
+    conf = conf_key.get()
+    if conf.seatsAvailable != seats:
+        oldSeats, conf.seatsAvailable = conf.seatsAvailable, seats
+        versions.touch(conf)
+        conf.put()
+        cache.invalidate(conf_key)
+        versions.bump(versions.conference(conf_key))
+        announcements.onCommitSeatsChanged(conf, oldSeats)
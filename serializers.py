@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""serializers.py
+
+Entity -> ProtoRPC message copy functions. Each (model, message) pair gets
+a copy function built once at import time from the two class definitions,
+so converting a row does no all_fields() reflection or per-field name
+checks.
+
+"""
+
+from google.appengine.ext import ndb
+from protorpc import messages
+
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+
+# model properties sent to the client as their str() form
+_STRING_PROPERTIES = (ndb.DateProperty, ndb.TimeProperty, ndb.DateTimeProperty)
+
+_SERIALIZERS = {}
+
+
+def _buildSerializer(model, message_cls):
+    """Return a function copying a `model` entity into a new `message_cls`."""
+    plain = []          # copied as is
+    converted = []      # (name, converter)
+    websafeKey = False
+    for field in message_cls.all_fields():
+        prop = getattr(model, field.name, None)
+        if isinstance(prop, ndb.Property):
+            if isinstance(field, messages.EnumField):
+                # stored as the enum name, looked up on the enum type
+                converted.append((field.name,
+                                  lambda value, enum=field.type: getattr(enum, value)))
+            elif isinstance(prop, _STRING_PROPERTIES):
+                converted.append((field.name, str))
+            else:
+                plain.append(field.name)
+        elif field.name == 'websafeKey':
+            websafeKey = True
+    plain = tuple(plain)
+    converted = tuple(converted)
+    # messages without required fields can never fail check_initialized()
+    required = any(field.required for field in message_cls.all_fields())
+
+    def serialize(entity):
+        values = dict((name, getattr(entity, name)) for name in plain)
+        for name, convert in converted:
+            values[name] = convert(getattr(entity, name))
+        if websafeKey:
+            values['websafeKey'] = entity.key.urlsafe()
+        message = message_cls(**values)
+        if required:
+            message.check_initialized()
+        return message
+
+    return serialize
+
+
+def register(model, message_cls):
+    """Build and register the copy function for a (model, message) pair."""
+    _SERIALIZERS[(model, message_cls)] = _buildSerializer(model, message_cls)
+
+
+def serialize(entity, message_cls):
+    """Return `entity` copied into a new `message_cls` message."""
+    return _SERIALIZERS[(type(entity), message_cls)](entity)
+
+
+def serializeMulti(entities, message_cls):
+    """Return a list of `message_cls` messages, one per entity, looking up
+    the copy function once for the whole batch.
+    """
+    entities = list(entities)
+    if not entities:
+        return []
+    serialize = _SERIALIZERS[(type(entities[0]), message_cls)]
+    return [serialize(entity) for entity in entities]
+
+
+register(Conference, ConferenceForm)
+register(Session, SessionForm)
+register(Profile, ProfileForm)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""sessionquery.py
+
+Session filter engine for querySessionsAdvanced. The datastore allows an
+inequality on one property only, so of the typeOfSession, startTime and
+sessionDate predicates the most selective ones are pushed to the datastore
+(the allowed types as a parallel equality union, plus one range) and the
+remaining range is applied as a streaming filter over the results.
+
+"""
+
+from models import Session
+from models import TypeOfSession
+
+ALL_SESSION_TYPES = tuple(sorted(t.name for t in TypeOfSession))
+
+
+def allowedSessionTypes(include=None, exclude=None):
+    """Return the sorted session type names matching include minus exclude;
+    an empty include means every type."""
+    types = set(include or ALL_SESSION_TYPES) - set(exclude or ())
+    return sorted(types)
+
+
+def _rangeFilters(prop, low, high, highInclusive):
+    """Return the ndb filters for low <= prop <(=) high."""
+    filters = []
+    if low is not None:
+        filters.append(prop >= low)
+    if high is not None:
+        filters.append(prop <= high if highInclusive else prop < high)
+    return filters
+
+
+def _inRange(value, low, high, highInclusive):
+    """Python twin of _rangeFilters for the streamed predicate."""
+    if value is None:
+        return False
+    if low is not None and value < low:
+        return False
+    if high is not None:
+        return value <= high if highInclusive else value < high
+    return True
+
+
+def buildSessionQuery(types, startTimeFrom=None, startTimeBefore=None,
+                      dateFrom=None, dateTo=None, ancestor=None):
+    """Plan a Session query for the given predicates.
+
+    types are the allowed typeOfSession names, startTimeFrom/startTimeBefore
+    a half open time of day window and dateFrom/dateTo an inclusive date
+    range. Returns (query, predicate) where predicate is None when the
+    datastore applies every filter, or (None, None) when nothing can match.
+    """
+    if not types:
+        return None, None
+
+    q = Session.query(ancestor=ancestor)
+    if set(types) != set(ALL_SESSION_TYPES):
+        # IN runs one equality query per type in parallel and merges them
+        q = q.filter(Session.typeOfSession.IN(list(types)))
+
+    ranges = {
+        'sessionDate': (Session.sessionDate, dateFrom, dateTo, True),
+        'startTime': (Session.startTime, startTimeFrom, startTimeBefore, False),
+    }
+    used = [name for name, (_, low, high, _) in sorted(ranges.items())
+            if low is not None or high is not None]
+
+    # a date range narrows a cross-conference search far more than a time
+    # of day window does, so that is the one the datastore gets
+    pushed = 'sessionDate' if 'sessionDate' in used else (used[0] if used else None)
+    streamed = [(name,) + ranges[name][1:] for name in used if name != pushed]
+
+    if pushed:
+        prop, low, high, highInclusive = ranges[pushed]
+        for f in _rangeFilters(prop, low, high, highInclusive):
+            q = q.filter(f)
+        q = q.order(prop)
+    # key order last keeps paging stable and lets cursors work for IN
+    q = q.order(Session.key)
+
+    predicate = None
+    if streamed:
+        def predicate(session):
+            return all(_inRange(getattr(session, name), low, high, inclusive)
+                       for name, low, high, inclusive in streamed)
+    return q, predicate
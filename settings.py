@@ -16,3 +16,9 @@ WEB_CLIENT_ID = '14809927468-vr8s1ohhpk7bsgfbe3kmihpclk7q4gb4.apps.googleusercon
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Per-endpoint latency / RPC instrumentation (see instrumentation.py), off
+# unless being profiled, and the share of instrumented calls that also keep
+# a per-RPC trace.
+INSTRUMENTATION_ENABLED = False
+TRACE_SAMPLE_RATE = 0.01
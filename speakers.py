@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""speakers.py
+
+The speaker -> session index. Speakers are identified by their normalized
+name so "John Doe" and "john  doe" are one speaker. Each (speaker, Session)
+pair is its own root SpeakerSession entity, keyed by both, so adding a
+session writes one small entity: no list to rewrite, and no entity group
+shared between a speaker's conferences.
+
+A speaker page is one keys-only query, resumed by cursor; the Session keys
+come from the index keys themselves. Being a global query it is eventually
+consistent, so a just-added session can take a moment to show up.
+
+"""
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Session
+from models import SpeakerSession
+
+INDEX_BATCH_SIZE = 200
+
+
+def normalizeSpeakerName(name):
+    """Return the canonical form of a speaker name used in the index."""
+    return ' '.join(name.split()).lower()
+
+
+def speakerSessionKey(name, s_key):
+    """Return the SpeakerSession key of a speaker's Session."""
+    return ndb.Key(SpeakerSession,
+                   u'%s|%s' % (normalizeSpeakerName(name), s_key.urlsafe()))
+
+
+def addSpeakerSessions(name, s_keys):
+    """Add Session keys to a speaker's index; adding one twice is harmless.
+
+    Within the caller's (xg) transaction, if any, so a Session and its
+    index entry are written together.
+    """
+    speaker = normalizeSpeakerName(name)
+    ndb.put_multi([SpeakerSession(key=speakerSessionKey(name, s_key),
+                                  speaker=speaker, sessionKey=s_key)
+                   for s_key in s_keys])
+
+
+def getSpeakerSessionKeys(name, pageSize, pageToken=None):
+    """Return (Session keys, nextPageToken) for one page of the Sessions
+    given by a speaker. Raises ValueError for an invalid pageToken."""
+    query = SpeakerSession.query(
+        SpeakerSession.speaker == normalizeSpeakerName(name)).order(
+        SpeakerSession.key)
+    try:
+        start = Cursor(urlsafe=pageToken) if pageToken else None
+        keys, cursor, more = query.fetch_page(
+            pageSize, start_cursor=start, keys_only=True)
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+        raise ValueError('Invalid pageToken: %s' % pageToken)
+    # the key name ends with the websafe Session key, which has no '|'
+    s_keys = [ndb.Key(urlsafe=key.id().rpartition('|')[2]) for key in keys]
+    return s_keys, (cursor.urlsafe() if more and cursor else None)
+
+
+def indexSpeakersBatch(cursor=None):
+    """Index one page of existing Sessions by speaker and queue a task for
+    the next page; used by the speaker migration task handler."""
+    start = Cursor(urlsafe=cursor) if cursor else None
+    sessions, nextCursor, more = Session.query().fetch_page(
+        INDEX_BATCH_SIZE, start_cursor=start, projection=[Session.speaker])
+
+    ndb.put_multi([SpeakerSession(key=speakerSessionKey(session.speaker, session.key),
+                                  speaker=normalizeSpeakerName(session.speaker),
+                                  sessionKey=session.key)
+                   for session in sessions])
+
+    if more and nextCursor:
+        taskqueue.add(params={'cursor': nextCursor.urlsafe()},
+            url='/tasks/index_speakers'
+        )
@@ -293,6 +293,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the token for the next page of conferences on the server, if any.
+     * @type {string}
+     */
+    $scope.nextPageToken = null;
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -414,6 +420,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferences = function () {
         $scope.submitted = false;
+        $scope.nextPageToken = null;
         if ($scope.selectedTab == 'ALL') {
             $scope.queryConferencesAll();
         } else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
@@ -423,12 +430,32 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * Fetches the next page of conferences from the server for the selected tab.
+     */
+    $scope.loadMoreConferences = function () {
+        if (!$scope.nextPageToken) {
+            return;
+        }
+        if ($scope.selectedTab == 'ALL') {
+            $scope.queryConferencesAll($scope.nextPageToken);
+        } else if ($scope.selectedTab == 'YOU_HAVE_CREATED') {
+            $scope.getConferencesCreated($scope.nextPageToken);
+        }
+    };
+
     /**
      * Invokes the conference.queryConferences API.
+     *
+     * @param pageToken the token of the page to fetch, or undefined for the first page.
      */
-    $scope.queryConferencesAll = function () {
+    $scope.queryConferencesAll = function (pageToken) {
         var sendFilters = {
-            filters: []
+            filters: [],
+            pageSize: $scope.pagination.pageSize
+        }
+        if (pageToken) {
+            sendFilters.pageToken = pageToken;
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -458,10 +485,14 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!pageToken) {
+                            $scope.conferences = [];
+                            $scope.pagination.currentPage = 0;
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.nextPageToken = resp.nextPageToken || null;
                     }
                     $scope.submitted = true;
                 });
@@ -470,10 +501,16 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 
     /**
      * Invokes the conference.getConferencesCreated method.
+     *
+     * @param pageToken the token of the page to fetch, or undefined for the first page.
      */
-    $scope.getConferencesCreated = function () {
+    $scope.getConferencesCreated = function (pageToken) {
+        var params = {pageSize: $scope.pagination.pageSize};
+        if (pageToken) {
+            params.pageToken = pageToken;
+        }
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated(params).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -495,10 +532,14 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
+                        if (!pageToken) {
+                            $scope.conferences = [];
+                            $scope.pagination.currentPage = 0;
+                        }
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.nextPageToken = resp.nextPageToken || null;
                     }
                     $scope.submitted = true;
                 });
@@ -0,0 +1,10 @@
+"""Tests. Run from the repository root with the App Engine SDK on the path:
+
+    PYTHONPATH=$SDK python -m unittest discover -s tests -t .
+
+"""
+
+import dev_appserver
+
+# the SDK's bundled libraries (yaml, webapp2, endpoints, ...)
+dev_appserver.fix_sys_path()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""test_announcements.py
+
+Conferences join and leave the nearly sold out announcement as their
+seatsAvailable crosses the threshold, including when the change commits
+in a transaction.
+
+"""
+
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from models import Conference
+
+import announcements
+import seats
+
+
+class AnnouncementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        ndb.get_context().clear_cache()
+
+        seatsAvailable = announcements.NEARLY_SOLD_OUT_SEATS + 3
+        self.conf = Conference(name='Tiny', maxAttendees=seatsAvailable,
+                               seatsAvailable=seatsAvailable, seatShards=1)
+        self.conf.put()
+        ndb.put_multi(seats.buildSeatShards(self.conf.key, seatsAvailable, 1))
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def changeSeats(self, change, times):
+        for _ in range(times):
+            ndb.transaction(lambda: change(self.conf.key.get()), xg=True)
+        seats.syncSeatsAvailable(self.conf.key)
+
+    def testRegistrationsCrossTheThreshold(self):
+        self.changeSeats(seats.takeSeat, 2)
+        self.assertEqual(announcements.getAnnouncement(), '')
+
+        self.changeSeats(seats.takeSeat, 2)
+        self.assertEqual(announcements.getAnnouncement(),
+                         announcements.ANNOUNCEMENT_TPL % 'Tiny')
+        self.assertEqual(announcements.nearlySoldOutKeys(), [self.conf.key])
+
+        self.changeSeats(seats.returnSeat, 2)
+        self.assertEqual(announcements.getAnnouncement(), '')
+        self.assertEqual(announcements.nearlySoldOutKeys(), [])
+
+    def testChangeCommittedInTransaction(self):
+        @ndb.transactional(xg=True)
+        def update():
+            conf = self.conf.key.get()
+            oldSeats = conf.seatsAvailable
+            conf.name = 'Tiny Con'
+            seats.resetSeats(conf, 2)
+            conf.put()
+            announcements.onCommitSeatsChanged(conf, oldSeats)
+
+        update()
+        self.assertEqual(announcements.getAnnouncement(),
+                         announcements.ANNOUNCEMENT_TPL % 'Tiny Con')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""test_serializers.py
+
+Checks the serializers copy functions against the all_fields() reflection
+copies they replaced, kept here as the reference.
+
+"""
+
+import datetime
+import unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import TeeShirtSize
+from models import TypeOfSession
+
+import serializers
+
+
+def legacyConferenceForm(conf):
+    """The original _copyConferenceToForm."""
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            # convert Date to date string; just copy others
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    cf.check_initialized()
+    return cf
+
+
+def legacySessionForm(session):
+    """The original _copySessionToForm."""
+    sf = SessionForm()
+    wssk = session.key.urlsafe()
+    for field in sf.all_fields():
+        if hasattr(session, field.name):
+            # format date/time fields to string for form.
+            if field.name.endswith('Date') or field.name.endswith('Time'):
+                setattr(sf, field.name, str(getattr(session, field.name)))
+            elif field.name == 'typeOfSession':
+                # lookup value of enum type
+                setattr(sf, field.name, getattr(TypeOfSession, getattr(session, field.name)))
+            else:
+                setattr(sf, field.name, getattr(session, field.name))
+        elif field.name == "websafeKey":
+            setattr(sf, field.name, wssk)
+    sf.check_initialized()
+    return sf
+
+
+def legacyProfileForm(prof):
+    """The original _copyProfileToForm, less the Registration lookup the
+    endpoint still does itself."""
+    pf = ProfileForm()
+    for field in pf.all_fields():
+        if hasattr(prof, field.name):
+            # convert t-shirt string to Enum; just copy others
+            if field.name == 'teeShirtSize':
+                setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
+            else:
+                setattr(pf, field.name, getattr(prof, field.name))
+    pf.check_initialized()
+    return pf
+
+
+class SerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.p_key = ndb.Key(Profile, 'user@example.com')
+        self.c_key = ndb.Key(Conference, 1, parent=self.p_key)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def assertSameForms(self, entities, message_cls, legacy):
+        expected = [legacy(entity) for entity in entities]
+        self.assertEqual(
+            [serializers.serialize(entity, message_cls) for entity in entities],
+            expected)
+        self.assertEqual(serializers.serializeMulti(entities, message_cls),
+                         expected)
+
+    def testConference(self):
+        self.assertSameForms([
+            Conference(key=self.c_key, name='PyCon', description='Python',
+                       organizerUserId='user@example.com',
+                       organizerDisplayName='user', topics=['Python', 'Web'],
+                       city='Portland', startDate=datetime.date(2026, 5, 1),
+                       endDate=datetime.date(2026, 5, 3), month=5,
+                       maxAttendees=100, seatsAvailable=40, version=3),
+            # unset dates (copied as 'None'), no topics, nothing optional
+            Conference(key=ndb.Key(Conference, 2, parent=self.p_key),
+                       name='Minimal'),
+        ], ConferenceForm, legacyConferenceForm)
+
+    def testSession(self):
+        self.assertSameForms([
+            Session(key=ndb.Key(Session, 1, parent=self.c_key),
+                    name='Keynote', description='Opening', speaker='Jane Doe',
+                    highlights=['ndb', 'memcache'],
+                    startTime=datetime.time(9, 30),
+                    sessionDate=datetime.date(2026, 5, 1),
+                    typeOfSession='KEYNOTE', duration=60),
+            # default type, unset date, time and duration, no highlights
+            Session(key=ndb.Key(Session, 2, parent=self.c_key),
+                    name='Minimal', speaker='John Doe'),
+        ], SessionForm, legacySessionForm)
+
+    def testProfile(self):
+        self.assertSameForms([
+            Profile(key=self.p_key, displayName='user',
+                    mainEmail='user@example.com', teeShirtSize='XL_W',
+                    conferenceKeysToAttend=[self.c_key.urlsafe()],
+                    sessionKeysWishlist=['a', 'b']),
+            # default size, no name, empty lists
+            Profile(key=ndb.Key(Profile, 'other@example.com')),
+        ], ProfileForm, legacyProfileForm)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""test_textindex.py
+
+Reindexing drops the postings of terms a document no longer contains,
+even when global queries have not caught up with the previous reindex.
+
+"""
+
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from models import Conference
+
+import textindex
+
+
+class TextIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # global queries see no unapplied writes at all
+        self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=0)
+        self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        ndb.get_context().set_cache_policy(False)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def search(self, text):
+        results, _ = textindex.search('Conference', text, 10)
+        return [doc for doc, _ in results]
+
+    def testQuickEditsLeaveNoStalePostings(self):
+        conf = Conference(name='Python Summit', city='Berlin')
+        conf.put()
+        textindex.indexEntities([conf.key])
+        conf.city = 'Paris'
+        conf.put()
+        textindex.indexEntities([conf.key])
+        conf.name = 'Rust Summit'
+        conf.put()
+        textindex.indexEntities([conf.key])
+
+        self.policy.SetProbability(1)
+        self.assertEqual(self.search('rust paris'), [conf.key])
+        self.assertEqual(self.search('berlin'), [])
+        self.assertEqual(self.search('python'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
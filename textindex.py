@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""textindex.py
+
+Inverted index for full-text search over Conferences and Sessions. Each
+distinct term of a document gets a Posting entity, keyed by kind, term and
+document, with a weight from the fields it occurs in. A term's postings are
+read in weight order by a single indexed query.
+
+A document's postings share an entity group of their own, under a
+PostingDoc key that has no entity. Reindexing can then find the current
+postings with a strongly consistent ancestor query.
+
+A search walks the posting list of its rarest term with a cursor. It
+checks each candidate against the other terms with one get_multi over
+their (deterministic) posting keys. Cost therefore grows with the posting
+lists involved, not with the number of documents.
+
+Documents are (re)indexed by the /tasks/index_text task after each write.
+
+"""
+
+import re
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Posting
+from models import Session
+
+# field weights per kind; a term's weight is the sum over its occurrences
+FIELD_WEIGHTS = {
+    'Conference': {'name': 5, 'topics': 3, 'city': 3, 'description': 1},
+    'Session': {'name': 5, 'speaker': 3, 'typeOfSession': 2,
+                'highlights': 2, 'description': 1},
+}
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'with'))
+MAX_DOCUMENT_TERMS = 200    # distinct terms indexed per document
+MAX_QUERY_TERMS = 5
+COUNT_LIMIT = 1000          # posting list sizes are compared up to this
+CHUNK_SIZE = 50             # postings checked per get_multi
+MAX_SCAN = 1000             # postings a page may read before returning
+INDEX_BATCH_SIZE = 100
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the index terms of `text`, in order, with repeats."""
+    return [token for token in _TOKEN_RE.findall(text.lower())
+            if len(token) > 1 and token not in STOPWORDS]
+
+
+def termWeights(entity):
+    """Return {term: weight} for a Conference or Session."""
+    weights = {}
+    for field, weight in FIELD_WEIGHTS[entity.key.kind()].items():
+        value = getattr(entity, field, None)
+        for text in (value if isinstance(value, list) else [value]):
+            if text:
+                for term in tokenize(unicode(text)):
+                    weights[term] = weights.get(term, 0) + weight
+    if len(weights) > MAX_DOCUMENT_TERMS:
+        kept = sorted(weights, key=lambda t: -weights[t])[:MAX_DOCUMENT_TERMS]
+        weights = dict((term, weights[term]) for term in kept)
+    return weights
+
+
+def _term(kind, term):
+    """Return the Posting.term value for a term of a kind."""
+    return u'%s:%s' % (kind, term)
+
+
+def _postingParent(doc_key):
+    """Return the entity group root of a document's postings."""
+    return ndb.Key('PostingDoc', doc_key.urlsafe())
+
+
+def _postingKey(kind, term, doc_key):
+    return ndb.Key(Posting, _term(kind, term), parent=_postingParent(doc_key))
+
+
+def indexEntities(keys):
+    """Bring the postings of the documents at `keys` up to date; a missing
+    document loses all its postings."""
+    entities = ndb.get_multi(keys)
+    # ancestor queries, so postings written by a reindex that just ran
+    # are seen (and dropped if stale)
+    existing = [Posting.query(ancestor=_postingParent(key)).fetch_async(
+                    keys_only=True)
+                for key in keys]
+    puts, deletes = [], []
+    for key, entity, future in zip(keys, entities, existing):
+        weights = termWeights(entity) if entity else {}
+        postings = [Posting(key=_postingKey(key.kind(), term, key),
+                            term=_term(key.kind(), term), doc=key, weight=weight)
+                    for term, weight in weights.items()]
+        current = set(posting.key for posting in postings)
+        deletes.extend(p_key for p_key in future.get_result()
+                       if p_key not in current)
+        puts.extend(postings)
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+
+
+def scheduleIndexing(keys, transactional=False):
+    """Queue the reindexing of the documents at `keys`."""
+    taskqueue.add(params={'key': [key.urlsafe() for key in keys]},
+                  url='/tasks/index_text', transactional=transactional)
+
+
+def indexingTasks(websafeKeys):
+    """Return the tasks reindexing the documents at `websafeKeys`, at most
+    INDEX_BATCH_SIZE per task to stay well inside the task size limit."""
+    return [taskqueue.Task(params={'key': websafeKeys[i:i + INDEX_BATCH_SIZE]},
+                           url='/tasks/index_text')
+            for i in range(0, len(websafeKeys), INDEX_BATCH_SIZE)]
+
+
+def indexAllBatch(kind, cursor=None):
+    """Index one page of existing documents of `kind` and queue a task for
+    the next page; used to build the index for data that predates it."""
+    model = {'Conference': Conference, 'Session': Session}[kind]
+    start = Cursor(urlsafe=cursor) if cursor else None
+    keys, nextCursor, more = model.query().fetch_page(
+        INDEX_BATCH_SIZE, start_cursor=start, keys_only=True)
+    if keys:
+        indexEntities(keys)
+    if more and nextCursor:
+        taskqueue.add(params={'kind': kind, 'cursor': nextCursor.urlsafe()},
+                      url='/tasks/index_text')
+
+
+def search(kind, text, pageSize, pageToken=None):
+    """Return ([(document key, score)], nextPageToken) for documents of
+    `kind` containing every term of `text`.
+
+    Pages follow the rarest term's posting list in weight order; within a
+    page results are ranked by their total weight over all the terms. The
+    page token names that term, so later pages keep scanning the same list
+    however the posting counts change in between. Raises ValueError for
+    more than MAX_QUERY_TERMS terms or an invalid pageToken.
+    """
+    terms = sorted(set(tokenize(text)))
+    if len(terms) > MAX_QUERY_TERMS:
+        raise ValueError('At most %d search terms are allowed.' % MAX_QUERY_TERMS)
+    if not terms:
+        return [], None
+
+    start = None
+    if pageToken:
+        driver, _, cursor = pageToken.partition(':')
+        if driver not in terms:
+            raise ValueError('Invalid pageToken: %s' % pageToken)
+        try:
+            start = Cursor(urlsafe=cursor)
+        except datastore_errors.BadValueError:
+            raise ValueError('Invalid pageToken: %s' % pageToken)
+    else:
+        # the rarest term drives the scan; an empty list means no results
+        counts = [Posting.query(Posting.term == _term(kind, term)).count_async(
+                      limit=COUNT_LIMIT) for term in terms]
+        counts = [future.get_result() for future in counts]
+        if not min(counts):
+            return [], None
+        driver = terms[counts.index(min(counts))]
+    others = [term for term in terms if term != driver]
+
+    query = Posting.query(Posting.term == _term(kind, driver)).order(-Posting.weight)
+    it = query.iter(start_cursor=start, produce_cursors=True,
+                    batch_size=CHUNK_SIZE)
+    try:
+        results, cursor, full, more = _scan(kind, it, others, pageSize)
+    except datastore_errors.BadRequestError:
+        # a cursor from some other query
+        raise ValueError('Invalid pageToken: %s' % pageToken)
+
+    nextPageToken = None
+    if cursor and (full or more):
+        nextPageToken = '%s:%s' % (driver, cursor.urlsafe())
+    results.sort(key=lambda result: -result[1])
+    return results, nextPageToken
+
+
+def _scan(kind, it, others, pageSize):
+    """Read driver postings from `it`, keeping documents that have all of
+    the `others` terms, until a page is full or MAX_SCAN postings are read.
+    Returns (results, cursor after the last posting read, whether the page
+    filled before the list ended, whether MAX_SCAN cut the scan short).
+    """
+    results, scanned, cursor, full = [], 0, None, False
+    while not full and scanned < MAX_SCAN:
+        chunk = []
+        while len(chunk) < CHUNK_SIZE and it.has_next():
+            posting = it.next()
+            chunk.append((posting, it.cursor_after()))
+        if not chunk:
+            break
+        scanned += len(chunk)
+        found = ndb.get_multi([_postingKey(kind, term, posting.doc)
+                               for posting, _ in chunk for term in others])
+        for i, (posting, cursor) in enumerate(chunk):
+            matches = found[i * len(others):(i + 1) * len(others)]
+            if all(matches):
+                results.append((posting.doc, posting.weight +
+                                sum(match.weight for match in matches)))
+                if len(results) >= pageSize:
+                    full = i < len(chunk) - 1 or it.probably_has_next()
+                    break
+    more = not full and scanned >= MAX_SCAN and it.probably_has_next()
+    return results, cursor, full, more
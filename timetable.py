@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""timetable.py
+
+Per-conference, per-day session timetables in memcache. A timetable is
+three parallel lists ordered by startTime: the start minutes, the
+typeOfSession and the id (under the Conference) of each of a day's
+Sessions. "Starting soon" is then a binary search and the day's grid is
+the list itself, with no query per call; only the Sessions picked are
+read, through the entity cache.
+
+A timetable is built from one ancestor query the first time it is read.
+A new Session is inserted into a cached timetable with gets/cas. When
+there is none, or the cas keeps failing, the timetable is dropped with a
+short lock, the same way cache.invalidate does, so a reader that built it
+just before the write cannot put the stale copy back.
+
+"""
+
+import bisect
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Session
+
+import cache
+
+TIMETABLE_VERSION = 2
+TIMETABLE_TTL = 60 * 60
+INVALIDATION_LOCK = 2
+CAS_RETRIES = 3
+
+
+def _cacheKey(c_key, day):
+    """Return the memcache key of a conference's timetable for a date."""
+    return 'TIMETABLE_v%d_%s_%s' % (TIMETABLE_VERSION, c_key.urlsafe(),
+                                    day.isoformat())
+
+
+def _minutes(t):
+    """Return a startTime as minutes after midnight (-1 when unset, so
+    such sessions sort first and never count as starting soon)."""
+    return t.hour * 60 + t.minute if t else -1
+
+
+def _build(c_key, day):
+    """Return the timetable of a conference day from the datastore."""
+    sessions = Session.query(ancestor=c_key).filter(
+        Session.sessionDate == day).fetch()
+    # sorted here, since ordering by startTime would need another index
+    sessions.sort(key=lambda sess: _minutes(sess.startTime))
+    return ([_minutes(sess.startTime) for sess in sessions],
+            [sess.typeOfSession for sess in sessions],
+            [sess.key.id() for sess in sessions])
+
+
+def getTimetable(c_key, day):
+    """Return (start minutes, types, Session ids) of a conference day, by
+    startTime."""
+    cache_key = _cacheKey(c_key, day)
+    timetable = memcache.get(cache_key)
+    if timetable is None:
+        timetable = _build(c_key, day)
+        # add rather than set, so a concurrent invalidation wins
+        memcache.add(cache_key, timetable, time=TIMETABLE_TTL)
+    return timetable
+
+
+def _getSessions(c_key, s_ids):
+    """Return the Sessions of a conference with ids `s_ids`, in order."""
+    sessions = cache.getMulti([ndb.Key(Session, s_id, parent=c_key)
+                               for s_id in s_ids])
+    return [sess for sess in sessions if sess]
+
+
+def daySessions(c_key, day, typeOfSession=None):
+    """Return the Sessions of a conference day by startTime, optionally
+    only those of one type."""
+    _, types, s_ids = getTimetable(c_key, day)
+    return _getSessions(c_key, [s_id for s_id, sessType in zip(s_ids, types)
+                                if typeOfSession in (None, sessType)])
+
+
+def startingAfter(c_key, day, t, count, typeOfSession=None):
+    """Return the first `count` Sessions of a day starting after time `t`,
+    optionally only those of one type."""
+    starts, types, s_ids = getTimetable(c_key, day)
+    i = bisect.bisect_right(starts, _minutes(t))
+    found = [s_id for s_id, sessType in zip(s_ids[i:], types[i:])
+             if typeOfSession in (None, sessType)]
+    return _getSessions(c_key, found[:count])
+
+
+def addSession(sess):
+    """Insert a newly stored Session into its day's cached timetable, if
+    there is one."""
+    if not sess.sessionDate:
+        return
+    cache_key = _cacheKey(sess.key.parent(), sess.sessionDate)
+    client = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        timetable = client.gets(cache_key)
+        if timetable is None:
+            # built on the next read, from a query that sees the session;
+            # the lock keeps out one built by a read that did not
+            break
+        starts, types, s_ids = timetable
+        if sess.key.id() in s_ids:
+            return
+        i = bisect.bisect_right(starts, _minutes(sess.startTime))
+        starts.insert(i, _minutes(sess.startTime))
+        types.insert(i, sess.typeOfSession)
+        s_ids.insert(i, sess.key.id())
+        if client.cas(cache_key, (starts, types, s_ids), time=TIMETABLE_TTL):
+            return
+    invalidate([sess])
+
+
+def invalidate(sessions):
+    """Drop the cached timetables of the days of `sessions`."""
+    cache_keys = set(_cacheKey(sess.key.parent(), sess.sessionDate)
+                     for sess in sessions if sess.sessionDate)
+    if cache_keys:
+        memcache.delete_multi(list(cache_keys), seconds=INVALIDATION_LOCK)
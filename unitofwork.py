@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""unitofwork.py
+
+Request-scoped unit of work. While an endpoint wrapped with @unitOfWork
+runs, entities put through put()/putMulti() outside a transaction are only
+marked dirty; they are written with one put_multi_async when the endpoint
+returns, so an entity saved twice costs one write, and reads through the
+entity cache are answered from the pending entities instead of the
+datastore. Work that must follow the write (cache invalidation, tasks that
+read the entities) is queued with callOnFlush().
+
+Entities put inside a transaction are written immediately, as the
+transaction needs them.
+
+"""
+
+import functools
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+STATS_KEY_TPL = 'UNIT_OF_WORK_STATS_%s_%s'
+STATS = ('put_calls', 'reads_skipped', 'rpcs')
+
+_local = threading.local()
+_endpointNames = set()
+
+
+class _UnitOfWork(object):
+    """The dirty entities and flush callbacks of one request."""
+
+    def __init__(self):
+        self.dirty = {}         # key -> entity
+        self.callbacks = []
+        self.stats = dict((stat, 0) for stat in STATS)
+
+
+def _current():
+    """Return the unit of work the current request may defer writes to."""
+    uow = getattr(_local, 'uow', None)
+    if uow is None or ndb.in_transaction():
+        return None
+    return uow
+
+
+def put(entity):
+    """Put `entity` when the unit of work flushes; returns its key."""
+    return putMulti([entity])[0]
+
+
+def putMulti(entities):
+    """Put `entities` when the unit of work flushes (at once outside of
+    one, or inside a transaction); returns their keys."""
+    uow = _current()
+    # entities without a complete key need the put to get one
+    if uow is None or any(not entity.key or not entity.key.id()
+                          for entity in entities):
+        return ndb.put_multi(entities)
+    for entity in entities:
+        uow.dirty[entity.key] = entity
+    # each deferred call is a put RPC the request would have made
+    uow.stats['put_calls'] += 1
+    return [entity.key for entity in entities]
+
+
+def getPending(key):
+    """Return the entity waiting to be written for `key`, or None."""
+    uow = _current()
+    entity = uow.dirty.get(key) if uow else None
+    if entity is not None:
+        uow.stats['reads_skipped'] += 1
+    return entity
+
+
+def callOnFlush(callback):
+    """Call `callback` once the pending writes are durable: on commit inside
+    a transaction, after the flush inside a unit of work, else at once."""
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(callback)
+        return
+    uow = _current()
+    if uow:
+        uow.callbacks.append(callback)
+    else:
+        callback()
+
+
+def _flush(uow):
+    """Write the dirty entities with one batch and run the callbacks."""
+    if uow.dirty:
+        futures = ndb.put_multi_async(uow.dirty.values())
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        uow.stats['rpcs'] += 1
+    for callback in uow.callbacks:
+        callback()
+
+
+def _countStats(name, stats):
+    offsets = dict((STATS_KEY_TPL % (name, stat), count)
+                   for stat, count in stats.items() if count)
+    if offsets:
+        memcache.Client().offset_multi_async(offsets, initial_value=0)
+
+
+def getStats():
+    """Return {endpoint: {'put_calls', 'reads_skipped', 'rpcs', 'saved'}}
+    where saved is the datastore calls avoided by deferring and coalescing:
+    the deferred put calls and skipped reads, less the flushes' put_multi."""
+    keys = [STATS_KEY_TPL % (name, stat)
+            for name in _endpointNames for stat in STATS]
+    values = memcache.get_multi(keys)
+    stats = {}
+    for name in _endpointNames:
+        counts = dict((stat, int(values.get(STATS_KEY_TPL % (name, stat)) or 0))
+                      for stat in STATS)
+        counts['saved'] = (counts['put_calls'] + counts['reads_skipped'] -
+                          counts['rpcs'])
+        stats[name] = counts
+    return stats
+
+
+def unitOfWork(method):
+    """Run an API method in a unit of work, flushing it before returning."""
+    name = method.__name__
+    _endpointNames.add(name)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'uow', None) is not None:
+            # already inside one; the outermost method flushes
+            return method(*args, **kwargs)
+        uow = _local.uow = _UnitOfWork()
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            _local.uow = None
+        _flush(uow)
+        _countStats(name, uow.stats)
+        return result
+
+    return wrapper
@@ -1,11 +1,124 @@
+import hashlib
 import json
 import os
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from models import Profile
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 2          # seconds per tokeninfo call
+TOKENINFO_ATTEMPTS = 3
+TOKENINFO_BUDGET = 3            # seconds for all attempts together
+TOKENINFO_BACKOFF = 0.1         # seconds before the first retry, doubling
+INVALID_TOKEN_TTL = 60          # seconds a rejected token stays rejected
+TOKEN_CACHE_SIZE = 1000         # tokens kept in process memory
+TOKEN_STATS_KEY_TPL = 'OAUTH_TOKEN_CACHE_STATS_%s'
+
+# token hash -> (user_id, expiry timestamp); lives as long as the instance
+_tokenCache = {}
+
+
+def _tokenCacheKey(token):
+    """Return the cache key for a token; tokens can exceed memcache's key
+    length and should not sit in memcache as is."""
+    return 'OAUTH_TOKEN_' + hashlib.sha256(token).hexdigest()
+
+
+def _countTokenStat(stat):
+    memcache.Client().offset_multi_async(
+        {TOKEN_STATS_KEY_TPL % stat: 1}, initial_value=0)
+
+
+def getTokenCacheStats():
+    """Return the token cache counters: memory and memcache hits, misses."""
+    stats = ('memory_hits', 'memcache_hits', 'misses')
+    values = memcache.get_multi([TOKEN_STATS_KEY_TPL % stat for stat in stats])
+    return dict((stat, int(values.get(TOKEN_STATS_KEY_TPL % stat) or 0))
+                for stat in stats)
+
+
+def _rememberToken(cache_key, user_id, expires):
+    """Keep a token's user_id in process memory until `expires`."""
+    if len(_tokenCache) >= TOKEN_CACHE_SIZE:
+        now = time.time()
+        for k in [k for k, (_, exp) in _tokenCache.items() if exp <= now]:
+            del _tokenCache[k]
+        if len(_tokenCache) >= TOKEN_CACHE_SIZE:
+            _tokenCache.clear()
+    _tokenCache[cache_key] = (user_id, expires)
+
+
+def _fetchTokenInfo(token, token_type):
+    """Look a token up at the tokeninfo endpoint; return the decoded reply,
+    {} if the token was rejected, or None if no answer came within
+    TOKENINFO_BUDGET seconds. Failed calls are retried with a short
+    backoff while the budget lasts."""
+    deadline = time.time() + TOKENINFO_BUDGET
+    for i in range(TOKENINFO_ATTEMPTS):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        rpc = urlfetch.create_rpc(deadline=min(TOKENINFO_DEADLINE, remaining))
+        urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_type, token))
+        try:
+            resp = rpc.get_result()
+        except urlfetch.Error:
+            resp = None
+        if resp is None or resp.status_code >= 500:
+            time.sleep(min(TOKENINFO_BACKOFF * 2 ** i,
+                           max(deadline - time.time(), 0)))
+            continue
+        if resp.status_code == 200:
+            return json.loads(resp.content)
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            if token_type == 'access_token':
+                return {}
+            # the id_token attempt does not count as a failure
+            token_type = 'access_token'
+            continue
+        return {}
+    return None
+
+
+def _getOAuthUserId(token, token_type):
+    """Return the user_id for a token from the in process cache, memcache
+    or, failing both, the tokeninfo endpoint; cached until the token
+    expires."""
+    cache_key = _tokenCacheKey(token)
+    now = time.time()
+
+    cached = _tokenCache.get(cache_key)
+    if cached and cached[1] > now:
+        _countTokenStat('memory_hits')
+        return cached[0]
+
+    cached = memcache.get(cache_key)
+    if cached:
+        _countTokenStat('memcache_hits')
+        _rememberToken(cache_key, *cached)
+        return cached[0]
+
+    _countTokenStat('misses')
+    user = _fetchTokenInfo(token, token_type)
+    if user is None:
+        # no answer; the next request asks again
+        return ''
+    user_id = user.get('user_id', '')
+    expires_in = int(user.get('expires_in') or 0)
+    if not user_id:
+        # rejected; remembered briefly so a bad token costs one lookup
+        # per INVALID_TOKEN_TTL rather than one per request
+        expires_in = INVALID_TOKEN_TTL
+    if expires_in > 0:
+        expires = now + expires_in
+        memcache.set(cache_key, (user_id, expires), time=expires_in)
+        _rememberToken(cache_key, user_id, expires)
+    return user_id
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -17,29 +130,14 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getOAuthUserId(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
         # this is just a sample that queries datastore for an existing profile
         # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
+        p_key = Profile.query(Profile.mainEmail == user.email()).get(keys_only=True)
+        if p_key:
+            return p_key.id()
         else:
             return str(uuid.uuid1().get_hex())
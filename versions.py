@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""versions.py
+
+Version numbers for conditional reads. Conference, Session and Profile
+entities carry a version that their write paths increment (see touch()).
+Next to that, memcache holds a generation counter for each response a
+client can revalidate:
+
+    conference(c_key)   the Conference, its seat count included
+    sessions(c_key)     the Conference's Sessions
+    profile(p_key)      the Profile, its registrations and wishlist
+
+Read endpoints build an ETag from these counters, with no datastore read,
+and answer a matching ifNoneMatch with an empty not-modified response.
+
+A counter lost to eviction is re-seeded from the clock in microseconds.
+Increments never catch up with the clock, so a re-seeded counter cannot
+repeat an old value. The worst case is one unneeded full response, never
+a stale not-modified.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+
+import unitofwork
+
+GENERATION_VERSION = 1
+GENERATION_TTL = 24 * 60 * 60
+
+
+def _cacheKey(name):
+    return 'GENERATION_v%d_%s' % (GENERATION_VERSION, name)
+
+
+def _seed():
+    return int(time.time() * 1000000)
+
+
+def conference(c_key):
+    """Return the generation name of a Conference."""
+    return 'Conference_' + c_key.urlsafe()
+
+
+def sessions(c_key):
+    """Return the generation name of a Conference's Sessions."""
+    return 'Sessions_' + c_key.urlsafe()
+
+
+def profile(p_key):
+    """Return the generation name of a Profile."""
+    return 'Profile_' + p_key.urlsafe()
+
+
+def touch(*entities):
+    """Increment the version of entities about to be written."""
+    for entity in entities:
+        entity.version = (entity.version or 0) + 1
+
+
+def bump(*names):
+    """Advance generations once the current transaction commits or unit of
+    work flushes (immediately when in neither).
+
+    Call it after cache.invalidate for the same write, so a reader that sees
+    the new generation cannot still read the old entity from the cache.
+    """
+    cache_keys = [_cacheKey(name) for name in names]
+    if cache_keys:
+        unitofwork.callOnFlush(lambda: memcache.offset_multi(
+            dict((cache_key, 1) for cache_key in cache_keys),
+            initial_value=_seed()))
+
+
+def getMulti(names):
+    """Return the current generation of each name (None if memcache is
+    unavailable), seeding missing ones."""
+    cache_keys = [_cacheKey(name) for name in names]
+    found = memcache.get_multi(cache_keys)
+    missing = [cache_key for cache_key in cache_keys if cache_key not in found]
+    if missing:
+        # add rather than set, so a concurrent bump wins
+        seed = _seed()
+        memcache.add_multi(dict((cache_key, seed) for cache_key in missing),
+                           time=GENERATION_TTL)
+        found.update(memcache.get_multi(missing))
+    return [found.get(cache_key) for cache_key in cache_keys]
+
+
+def etag(names, *extra):
+    """Return the ETag of a response built from the `names` generations
+    (and `extra` request parameters), or None if one is unknown.
+
+    Read the ETag before the data, so it is never newer than the data.
+    """
+    generations = getMulti(names)
+    if None in generations:
+        return None
+    digest = hashlib.sha1(repr((names, generations, extra))).hexdigest()
+    return '"%s"' % digest[:20]
+
+
+def matches(etag, ifNoneMatch):
+    """Return True if an If-None-Match value (a list of ETags, or *)
+    matches `etag`."""
+    if not etag or not ifNoneMatch:
+        return False
+    candidates = [tag.strip() for tag in ifNoneMatch.split(',')]
+    # weak comparison, as If-None-Match uses
+    return any(tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag
+               for tag in candidates)